@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+"""Shared MQTT plumbing for the Home Assistant bridges.
+
+Handles finding the broker via DNS SRV records, reconnecting with backoff,
+only publishing Home Assistant discovery configs when they've actually changed,
+holding onto publishes while disconnected, and pinging the availability topic on a timer.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import typing
+import uuid
+
+import dns.rdatatype
+import dns.resolver
+import paho.mqtt.client
+
+
+def node_id() -> str:
+    """Hex representation of this machine's MAC address, as used in the bridges' unique_ids."""
+    # NOTE: Not zero-padded, changing that would change every existing unique_id
+    return f'{uuid.getnode():02x}'
+
+
+def mac_address() -> str:
+    """Colon separated MAC address, for Home Assistant's device connections."""
+    mac = node_id()
+    return ':'.join(mac[i:i + 2] for i in range(0, len(mac), 2))
+
+
+class SRVResolver:
+    """Pick which of the broker's SRV targets to connect to, per RFC 2782.
+
+    Answers are cached for their TTL rather than looked up on every (re)connect.
+    Within each priority the targets are shuffled by weight,
+    but once we've connected to some of them the fastest of those is preferred,
+    and any that failed are left until last.
+    """
+
+    # Smoothing factor for the connect latency moving averages
+    LATENCY_ALPHA = 0.3
+
+    def __init__(self):
+        # {rr: (expiry as time.time(), [(host, port, priority, weight), ...])}
+        self._cache: dict[str, tuple[float, list[tuple[str, int, int, int]]]] = {}
+        # {(host, port): average connect latency, or inf if the last attempt failed}
+        self.latency: dict[tuple[str, int], float] = {}
+
+    def lookup(self, domain: str | None = None, secure: bool = False) -> list[tuple[str, int, int, int]]:
+        """The MQTT broker's SRV records as (host, port, priority, weight), from the cache if they haven't expired.
+
+        domain is the DNS domain to search for SRV records; if None,
+        try to determine local domain name.
+        """
+        if domain is None:
+            domain = socket.getfqdn()
+            domain = domain[domain.find('.') + 1:]
+
+        rr = '_mqtt._tcp.%s' % domain
+        if secure:
+            # IANA specifies secure-mqtt (not mqtts) for port 8883
+            rr = '_secure-mqtt._tcp.%s' % domain
+
+        cached = self._cache.get(rr)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        try:
+            response = dns.resolver.resolve(rr, dns.rdatatype.SRV)
+            answers = []
+            for answer in response:
+                addr = answer.target.to_text()[:-1]
+                answers.append(
+                    (addr, answer.port, answer.priority, answer.weight))
+        except (dns.resolver.NXDOMAIN,
+                dns.resolver.NoAnswer,
+                dns.resolver.NoNameservers):
+            raise ValueError("No answer/NXDOMAIN for SRV in %s" % (domain))
+
+        self._cache[rr] = (response.expiration, answers)
+        return answers
+
+    def _latency_key(self, answer: tuple[str, int, int, int]):
+        latency = self.latency.get(answer[:2])
+        if latency is None:
+            return (1, 0)
+        elif latency == float('inf'):
+            return (2, 0)
+        else:
+            return (0, latency)
+
+    def order(self, answers: list[tuple[str, int, int, int]]) -> list[tuple[str, int, int, int]]:
+        """Order the targets to try, lowest priority first."""
+        ordered = []
+        for priority in sorted({answer[2] for answer in answers}):
+            remaining = [answer for answer in answers if answer[2] == priority]
+            # RFC 2782: Zero weight targets go first so they have a (very small) chance of being picked
+            remaining.sort(key=lambda answer: answer[3] != 0)
+            shuffled = []
+            while remaining:
+                pick = random.uniform(0, sum(answer[3] for answer in remaining))
+                running_sum = 0
+                for answer in remaining:
+                    running_sum += answer[3]
+                    if running_sum >= pick:
+                        break
+                remaining.remove(answer)
+                shuffled.append(answer)
+            # Stable sort, so the targets we know nothing about yet stay in their weighted order
+            ordered.extend(sorted(shuffled, key=self._latency_key))
+        return ordered
+
+    def record_latency(self, host: str, port: int, latency: float):
+        previous = self.latency.get((host, port))
+        if previous is None or previous == float('inf'):
+            self.latency[(host, port)] = latency
+        else:
+            self.latency[(host, port)] = previous + self.LATENCY_ALPHA * (latency - previous)
+
+    def record_failure(self, host: str, port: int):
+        self.latency[(host, port)] = float('inf')
+
+
+srv_resolver = SRVResolver()
+
+
+def resolve_srv(domain: str | None = None, secure: bool = False) -> list[tuple[str, int, int, int]]:
+    """Look up the MQTT broker's SRV records, returning (host, port, priority, weight) in the order to try them."""
+    return srv_resolver.order(srv_resolver.lookup(domain, secure))
+
+
+# Since upstream **still** hasn't fixed this 3yr old bug
+# https://github.com/eclipse/paho.mqtt.python/issues/493
+# I've copy/pasted upstream's connect_srv function to fix it internally.
+# I've also pushed my own pull request for them
+# https://github.com/eclipse/paho.mqtt.python/pull/759
+# but I get the feeling it's going to be ignored
+# -- mijofa, 2023-10-23
+def connect_srv(mqtt_client, domain=None, *args, **kwargs):
+    """Connect to a remote broker.
+
+    domain is the DNS domain to search for SRV records; if None,
+    try to determine local domain name.
+    All other args are used as is for connect()
+    """
+    error = None
+    for host, port, prio, weight in resolve_srv(domain, secure=bool(mqtt_client._ssl)):
+        started = time.monotonic()
+        try:
+            ret = mqtt_client.connect(host, port, *args, **kwargs)
+        except OSError as e:
+            print(f"MQTT broker {host}:{port} failed:", e, file=sys.stderr, flush=True)
+            srv_resolver.record_failure(host, port)
+            error = e
+            continue
+        srv_resolver.record_latency(host, port, time.monotonic() - started)
+        return ret
+
+    raise ValueError("No SRV hosts responded") from error
+
+
+def _succeeded(reason_code) -> bool:
+    # paho 2.x gives a ReasonCode, 1.x gives an int
+    if hasattr(reason_code, 'is_failure'):
+        return not reason_code.is_failure
+    return reason_code == 0
+
+
+class MQTTBridge:
+    """A paho client with the connection, discovery, & availability handling every bridge needs.
+
+    Everything should be published via publish() rather than the paho client directly,
+    so that messages are queued up while disconnected rather than dropped.
+    The queue only keeps the latest message for each topic, since older states are irrelevant by the time we reconnect.
+    """
+
+    def __init__(self, availability_topic: str, host: str | None = None, port: int = 1883,
+                 username: str | None = 'guest', password: str | None = 'guest',
+                 heartbeat_interval: float = 60, reconnect_delay: tuple[float, float] = (1, 120)):
+        self.availability_topic = availability_topic
+        self.host = host
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self._reconnect_delay_min, self._reconnect_delay_max = reconnect_delay
+        self._reconnect_delay = self._reconnect_delay_min
+
+        if hasattr(paho.mqtt.client, 'CallbackAPIVersion'):
+            self.client = paho.mqtt.client.Client(
+                callback_api_version=paho.mqtt.client.CallbackAPIVersion.VERSION2)
+        else:
+            self.client = paho.mqtt.client.Client()
+        # NOTE: The will must be set before connecting.
+        self.client.will_set(topic=availability_topic, payload='offline')
+        # FIXME: Try anonymous, and fallback on guest:guest when that fails
+        if username is not None:
+            self.client.username_pw_set(username=username, password=password)
+        self.client.on_connect = self._on_connect
+        self.client.on_connect_fail = self._on_connect_fail
+        self.client.on_disconnect = self._on_disconnect
+
+        self._lock = threading.RLock()
+        self.connected = False
+        # Whether the availability topic should be saying 'online', left to the bridge to decide when it's ready
+        self.available = False
+        # {topic: (payload, retain)} waiting to be published
+        self._queue: dict[str, tuple[str, bool]] = {}
+        # {topic: sha256 of payload} for each discovery config already published
+        self._discovery_hashes: dict[str, str] = {}
+        # {topic: callback} to (re)subscribe to on every connect
+        self._subscriptions: dict[str, typing.Callable] = {}
+        # SRV target loop_start()'s thread is currently trying
+        self._srv_target: tuple[str, int] | None = None
+
+    def connect(self):
+        """Connect to the configured broker, or find one via DNS SRV records if none was configured."""
+        if self.host is not None:
+            return self.client.connect(self.host, self.port)
+        return connect_srv(self.client)
+
+    def connect_async(self):
+        """Same as connect(), but leave the actual connection to loop_start()'s thread, so a missing broker isn't fatal."""
+        if self.host is not None:
+            return self.client.connect_async(self.host, self.port)
+        # FIXME: The SRV lookup still happens synchronously
+        return self._connect_next_srv_async()
+
+    def _connect_next_srv_async(self):
+        targets = [answer[:2] for answer in resolve_srv(secure=bool(self.client._ssl))]
+        if self._srv_target in targets:
+            # Fail over to whichever target is next in line after the one that failed
+            targets = targets[targets.index(self._srv_target) + 1:] + targets[:targets.index(self._srv_target)] or targets
+        self._srv_target = targets[0]
+        return self.client.connect_async(*self._srv_target)
+
+    def _on_connect_fail(self, client, userdata):
+        # Only called from loop_start()'s thread, which would otherwise keep retrying the same host forever.
+        # NOTE: Latency can't be measured here since paho's reconnect backoff happens in the same thread.
+        if self.host is None and self._srv_target is not None:
+            srv_resolver.record_failure(*self._srv_target)
+            self._connect_next_srv_async()
+
+    def next_reconnect_delay(self) -> float:
+        """How long to wait before the next reconnect attempt, doubling each time until a connection succeeds."""
+        delay = self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, self._reconnect_delay_max)
+        # Jitter so every bridge on the network doesn't hit the broker at the same moment after it restarts
+        return delay * random.uniform(0.5, 1.5)
+
+    def _on_connect(self, client, userdata, flags, reason_code, *args):
+        if not _succeeded(reason_code):
+            print("MQTT connection refused:", reason_code, file=sys.stderr, flush=True)
+            return
+        with self._lock:
+            self.connected = True
+            self._reconnect_delay = self._reconnect_delay_min
+            for topic, callback in self._subscriptions.items():
+                self.client.message_callback_add(sub=topic, callback=callback)
+                self.client.subscribe(topic=topic)
+            if self.available:
+                self._queue[self.availability_topic] = ('online', False)
+        self.flush()
+
+    def _on_disconnect(self, client, userdata, *args):
+        with self._lock:
+            self.connected = False
+
+    def subscribe(self, topic: str, callback: typing.Callable):
+        """Subscribe to a topic, and keep resubscribing to it whenever we reconnect."""
+        with self._lock:
+            self._subscriptions[topic] = callback
+            if self.connected:
+                self.client.message_callback_add(sub=topic, callback=callback)
+                self.client.subscribe(topic=topic)
+
+    def unsubscribe(self, topic: str):
+        with self._lock:
+            self._subscriptions.pop(topic, None)
+            if self.connected:
+                self.client.unsubscribe(topic=topic)
+                self.client.message_callback_remove(sub=topic)
+
+    def publish(self, topic: str, payload: str, retain: bool = False):
+        """Queue a message, and publish it straight away if we're connected."""
+        with self._lock:
+            self._queue[topic] = (payload, retain)
+        self.flush()
+
+    def flush(self):
+        """Publish everything that's been queued up, so long as we're connected."""
+        with self._lock:
+            while self.connected and self._queue:
+                topic, (payload, retain) = next(iter(self._queue.items()))
+                if self.client.publish(topic=topic, payload=payload, retain=retain).rc != paho.mqtt.client.MQTT_ERR_SUCCESS:
+                    # Leave it queued until we reconnect
+                    break
+                del self._queue[topic]
+
+    def publish_discovery(self, topic: str, config: dict) -> bool:
+        """Publish a Home Assistant discovery config, unless exactly the same config has already been published."""
+        payload = json.dumps(config, sort_keys=True)
+        digest = hashlib.sha256(payload.encode()).hexdigest()
+        with self._lock:
+            if self._discovery_hashes.get(topic) == digest:
+                return False
+            self._discovery_hashes[topic] = digest
+        self.publish(topic=topic, payload=payload, retain=True)
+        return True
+
+    def clear_discovery(self, topic: str):
+        """Remove a Home Assistant discovery config, which removes the entity from Home Assistant."""
+        with self._lock:
+            self._discovery_hashes.pop(topic, None)
+        self.publish(topic=topic, payload='', retain=True)
+
+    def set_available(self, available: bool = True):
+        """Tell Home Assistant whether to trust what we're publishing."""
+        self.available = available
+        self.publish(topic=self.availability_topic, payload='online' if available else 'offline')
+
+    def heartbeat(self):
+        """Remind Home Assistant we're still here, in case it's restarted and forgotten."""
+        if self.available:
+            self.publish(topic=self.availability_topic, payload='online')
+
+    def loop_start(self):
+        """Run paho's own network thread, with a timer thread for the heartbeats."""
+        self.client.reconnect_delay_set(min_delay=int(self._reconnect_delay_min),
+                                        max_delay=int(self._reconnect_delay_max))
+        self.client.loop_start()
+
+        def heartbeat():
+            self.heartbeat()
+            timer = threading.Timer(self.heartbeat_interval, heartbeat)
+            timer.daemon = True
+            timer.start()
+
+        timer = threading.Timer(self.heartbeat_interval, heartbeat)
+        timer.daemon = True
+        timer.start()
+
+
+class AsyncioDriver:
+    """Drive a bridge's paho socket from an asyncio event loop instead of its own loop_start() thread.
+
+    ref: https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
+    """
+
+    def __init__(self, bridge: MQTTBridge, loop: asyncio.AbstractEventLoop):
+        self.bridge = bridge
+        self.client = bridge.client
+        self.loop = loop
+        self.closed = asyncio.Event()
+        self._misc: asyncio.Task | None = None
+        self._heartbeat: asyncio.Task | None = None
+        self._stopping = False
+        # NOTE: The socket callbacks must be set before connecting.
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def start(self):
+        """Connect (retrying in the background if that fails) and start the heartbeats."""
+        self.reconnect()
+        self._heartbeat = self.loop.create_task(self.heartbeat_loop())
+
+    def on_socket_open(self, client, userdata, sock):
+        self.closed.clear()
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+        self.closed.set()
+        if not self._stopping:
+            self.loop.call_later(self.bridge.next_reconnect_delay(), self.reconnect)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        """Handle keepalives & retries, like the rest of paho's loop() would."""
+        while self.client.loop_misc() == paho.mqtt.client.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.bridge.heartbeat_interval)
+            self.bridge.heartbeat()
+
+    def reconnect(self):
+        if self._stopping:
+            return
+        try:
+            self.bridge.connect()
+        except (OSError, ValueError) as e:
+            delay = self.bridge.next_reconnect_delay()
+            print(f"MQTT connection failed, retrying in {delay:.1f}s:", e, file=sys.stderr, flush=True)
+            self.loop.call_later(delay, self.reconnect)
+
+    async def disconnect(self, timeout: float = 5):
+        """Cleanly disconnect, waiting for anything already queued to be sent first."""
+        self._stopping = True
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        if not self.bridge.connected:
+            return
+        self.client.disconnect()
+        try:
+            await asyncio.wait_for(self.closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            print("Timed out waiting for MQTT to disconnect", file=sys.stderr)
@@ -4,11 +4,9 @@ import json
 import logging
 import pathlib
 
-import paho.mqtt.client
-# FIXME: Should I be using wait_for_publish more?
-#        In theory it shouldn't matter because most publishes "should" work,
-#        and it's fine if a loop or 2 fails
-#        https://pypi.org/project/paho-mqtt/
+import hass_mqtt
+# NOTE: Everything goes through the bridge's publish queue,
+#       so publishes made while the broker is unreachable are sent once it's back rather than dropped.
 
 from NovaApi.ListDevices.nbe_list_devices import request_device_list
 from ProtoDecoders.decoder import parse_device_update_protobuf
@@ -74,7 +72,7 @@ def location_update_handler(resp_hex):
         data['last_time_reachable'] = timestamp.strftime('%Y-%m-%dT%H:%M:%S%z')  # Android App
         data['last_timestamp'] = timestamp.strftime('%Y-%m-%dT%H:%M:%S%z')  # Tile integration
         # data['last_lost_timestamp']  # Pretty sure this is for when someone tells Tile that the tracker has been lost, not (yet) relevant here.
-        mqtt_client.publish(
+        bridge.publish(
             topic='/'.join((MQTT_TOPIC_BASE, canonic_id.id, "attributes")),
             payload=json.dumps(data),
         )
@@ -104,9 +102,9 @@ AVAILABILITY_TOPIC: str = '/'.join((MQTT_TOPIC_BASE, "availability"))
 
 def mqtt_discovery(id: str, device):
     """Send MQTT discovery info for Home Assistant."""
-    mqtt_client.publish(
+    bridge.publish_discovery(
         topic='/'.join((MQTT_TOPIC_BASE, id, "config")),
-        payload=json.dumps({
+        config={
             "platform": "device_tracker",
             "source_type": "bluetooth_le",  # FIXME: Depends on device type!
             "device": {
@@ -126,7 +124,7 @@ def mqtt_discovery(id: str, device):
             "name": device.userDefinedDeviceName,
             # "state_topic": '/'.join((MQTT_TOPIC_BASE, id, "state")),
             "unique_id": f'google-find-hub_{id}',
-        }),
+        },
     )
 
 
@@ -140,19 +138,12 @@ if __name__ == '__main__':
 
     polling_interval: int = config['polling_interval_mins']
 
-    global mqtt_client
-    mqtt_client = paho.mqtt.client.Client(
-        # We don't actually use these callbacks at all (yet?)
-        # but there's a deprecation warning if I don't set this.
-        callback_api_version=paho.mqtt.client.CallbackAPIVersion.VERSION2)
-    mqtt_client.enable_logger()  # FIXME: wtf is this not just a thing already.
-    # NOTE: The will must be set before connecting.
-    mqtt_client.will_set(topic=AVAILABILITY_TOPIC, payload='offline')
-    # FIXME: Try anonymous, and fallback on guest:guest when that fails
-    mqtt_client.username_pw_set(username='guest', password='guest')
-    mqtt_client.connect_async(host=config['mqtt_host'], port=config['mqtt_port'])
-    mqtt_client.loop_start()
-    mqtt_client.will_set(topic=AVAILABILITY_TOPIC, payload="offline")
+    global bridge
+    bridge = hass_mqtt.MQTTBridge(AVAILABILITY_TOPIC, host=config['mqtt_host'], port=config['mqtt_port'])
+    bridge.client.enable_logger()  # FIXME: wtf is this not just a thing already.
+    # NOTE: Not using hass_mqtt.AsyncioDriver because the asyncio loop here only runs in between the blocking Google requests.
+    bridge.connect_async()
+    bridge.loop_start()
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -160,6 +151,8 @@ if __name__ == '__main__':
     fcm = FcmReceiver()
     loop.run_until_complete(fcm._register_for_fcm_and_listen())
     fcm_token = fcm.register_for_location_updates(location_update_handler)
+    # The bridge's heartbeats keep this up to date from here on
+    bridge.set_available(True)
 
     # NOTE: Google remembers these requests across runs.
     #       So if you Ctrl-C and rerun, you may start seening extra results,
@@ -168,7 +161,6 @@ if __name__ == '__main__':
     fail_count = 0
     while True:
         try:
-            mqtt_client.publish(topic=AVAILABILITY_TOPIC, payload="online")
             loop.run_until_complete(asyncio.gather(
                 send_new_location_requests(fcm_token=fcm_token),
                 asyncio.sleep(delay=60 * polling_interval),
@@ -0,0 +1 @@
+google-find-hub/hass_mqtt.py
\ No newline at end of file
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+"""
+Compare how many requests & how long jellyfin_missing_aired_episodes.py takes in each of its fetching modes,
+against a fake Jellyfin with a made up library and a fixed delay on every request.
+"""
+import argparse
+import http.server
+import json
+import pathlib
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+SCRIPT = pathlib.Path(__file__).with_name('jellyfin_missing_aired_episodes.py')
+# (description, extra arguments)
+MODES = [('per series, --jobs 1', ['--jobs', '1']),
+         ('per series, --jobs 8', ['--jobs', '8']),
+         ('--bulk', ['--bulk'])]
+# Jellyfin's sortBy names for the episode fields they sort on, anything else isn't an ItemSortBy and gets ignored
+SORT_FIELDS = {'SeriesSortName': 'SeriesName', 'Name': 'Name', 'PremiereDate': 'PremiereDate',
+               'ParentIndexNumber': 'ParentIndexNumber', 'IndexNumber': 'IndexNumber'}
+
+argparser = argparse.ArgumentParser(description=__doc__)
+argparser.add_argument('--series', type=int, default=300,
+                       help="How many series in the fake library")
+argparser.add_argument('--latency', type=float, default=0.02,
+                       help="Seconds the fake Jellyfin takes to answer each request")
+argparser.add_argument('--page-size', type=int, default=2000,
+                       help="Passed on to the --bulk run")
+argparser.add_argument('--seed', type=int, default=1,
+                       help="Random seed for the fake library, so runs are comparable")
+argparser.add_argument('--shuffle-ties', action='store_true',
+                       help="Give items that sort the same a different order in every request, which Jellyfin is free to do")
+args = argparser.parse_args()
+
+
+def make_library(series_count):
+    """Return (users, series, episodes, {user ID: played episode IDs}) for a made up library."""
+    rng = random.Random(args.seed)
+    users = [{'Id': 'user1', 'Name': 'Alice', 'HasPassword': True},
+             {'Id': 'user2', 'Name': 'Bob', 'HasPassword': True}]
+    series = []
+    episodes = []
+    for series_number in range(series_count):
+        # Few enough names that some series share one, like remakes do
+        series.append({'Id': f'series{series_number:05}', 'Name': f'Show {rng.randrange(series_count // 2 or 1)}',
+                       'Type': 'Series', 'Status': 'Ended' if rng.random() < 0.2 else 'Continuing',
+                       'ExternalUrls': [{'Name': 'IMDb', 'Url': f'https://www.imdb.com/title/tt{series_number:07}'}]})
+        episode_count = rng.randrange(5, 60)
+        missing_count = rng.randrange(0, 4)
+        for episode_number in range(episode_count):
+            season, index = divmod(episode_number, 12)
+            episode = {'Id': f'{series[-1]["Id"]}-{episode_number:03}', 'Type': 'Episode',
+                       'SeriesId': series[-1]['Id'], 'SeriesName': series[-1]['Name'],
+                       'Name': f'Episode {episode_number}', 'SeasonName': f'Season {season + 1}',
+                       'ParentIndexNumber': season + 1, 'IndexNumber': index + 1,
+                       'PremiereDate': f'{2000 + episode_number // 6}-{index + 1:02}-01T00:00:00.0000000Z',
+                       'RuntimeTicks': 30 * 600000000}
+            if episode_number < episode_count - missing_count:
+                episode['Path'] = f'/media/{series[-1]["Id"]}/{episode_number}.mkv'
+            episodes.append(episode)
+    # Everyone's watched the first few episodes of most things
+    played = {user['Id']: {episode['Id'] for episode in episodes
+                           if episode['ParentIndexNumber'] == 1 and episode['IndexNumber'] <= rng.randrange(1, 4)}
+              for user in users}
+    return users, series, episodes, played
+
+
+class FakeJellyfin(http.server.BaseHTTPRequestHandler):
+    """Just enough of Jellyfin's API for jellyfin_missing_aired_episodes.py, ignoring the MinDateLastSaved filters."""
+    protocol_version = 'HTTP/1.1'
+    library = None
+    rng = random.Random(args.seed)
+    requests = 0
+    requests_lock = threading.Lock()
+
+    def do_GET(self):
+        time.sleep(args.latency)
+        with self.requests_lock:
+            FakeJellyfin.requests += 1
+
+        users, series, episodes, played = self.library
+        url = urllib.parse.urlsplit(self.path)
+        query = {key.lower(): value for key, value in urllib.parse.parse_qsl(url.query)}
+        if url.path == '/Users':
+            return self.reply(users)
+        elif url.path.startswith('/Shows/') and url.path.endswith('/Episodes'):
+            series_id = url.path.split('/')[2]
+            return self.reply({'Items': [episode for episode in episodes if episode['SeriesId'] == series_id]})
+        elif url.path == '/Items' and query.get('includeitemtypes') == 'Series':
+            return self.reply({'Items': [s for s in series if s['Status'] == query.get('seriesstatus', s['Status'])]})
+        elif url.path == '/Items':
+            items = episodes
+            if query.get('isplayed') == 'True':
+                items = [episode for episode in items if episode['Id'] in played[query['userid']]]
+            if args.shuffle_ties:
+                items = self.rng.sample(items, len(items))
+            if 'sortby' in query:
+                fields = [SORT_FIELDS[field] for field in query['sortby'].split(',') if field in SORT_FIELDS]
+                items = sorted(items, key=lambda item: [item.get(field) for field in fields])
+            total = len(items)
+            start_index = int(query.get('startindex', 0))
+            if 'limit' in query:
+                items = items[start_index:start_index + int(query['limit'])]
+            return self.reply({'Items': items, 'TotalRecordCount': total})
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def reply(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    FakeJellyfin.library = make_library(args.series)
+    server = http.server.ThreadingHTTPServer(('localhost', 0), FakeJellyfin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://localhost:{server.server_address[1]}/'
+    print(f"{args.series} series, {len(FakeJellyfin.library[2])} episodes, {args.latency * 1000:.0f}ms per request",
+          flush=True)
+
+    outputs = {}
+    for description, extra_args in MODES:
+        if '--bulk' in extra_args:
+            extra_args = extra_args + ['--page-size', str(args.page_size)]
+        FakeJellyfin.requests = 0
+        start = time.monotonic()
+        outputs[description] = subprocess.check_output([sys.executable, str(SCRIPT), '--base-url', base_url,
+                                                        '--token', 'benchmark', '--home-assistant', base_url,
+                                                        *extra_args], text=True)
+        print(f"  {description + ':':24}{FakeJellyfin.requests:5} requests, {time.monotonic() - start:5.1f}s",
+              flush=True)
+
+    if len(set(outputs.values())) == 1:
+        print("Output was identical in all of them")
+    else:
+        print("Output differed between them!", file=sys.stderr)
+        sys.exit(1)
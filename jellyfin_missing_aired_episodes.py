@@ -2,16 +2,34 @@
 """Find any new episodes available for Jellyfin's list of TV shows."""
 import sys
 import argparse
+import concurrent.futures
 import datetime
+import http.client
+import http.server
+import io
+import itertools
 import json
 import pathlib
+import threading
+import time
+import urllib.error
 import urllib.parse
-import urllib.request
 
-TODAY = datetime.datetime.now().date()
 MAX_EPISODES_TO_DISPLAY = 5
 # ref: https://github.com/jellyfin/jellyfin-web/blob/master/src/controllers/playback/video/index.js#L30
 TICKS_PER_MINUTE = 600000000
+# Bump this whenever the cache file's layout changes, older caches are thrown away
+CACHE_VERSION = 1
+# Ask for changes since a little before the last run, in case Jellyfin's clock disagrees with ours
+CACHE_CLOCK_SLACK = datetime.timedelta(minutes=5)
+# How long to let a burst of webhooks die down before rescanning
+WEBHOOK_SETTLE_SECONDS = 5
+HOMEASSISTANT_DEFAULTS = {'title_default': '$title',
+                          'line1_default': '$number - $episode',
+                          'line2_default': '$release',
+                          'line3_default': '$rating',
+                          'line4_default': '$studio',
+                          'icon': 'mdi:arrow-down-bold-circle'}
 
 # A user that has "Display missing episodes within seasons" enabled in their profile
 # FIXME: WTF?! Just tell every user to do this, it's not actually annoying in the UX
@@ -33,6 +51,42 @@ def _get_IMDBid(series):
     return series['ExternalUrls']['IMDb'].rpartition('/')[-1] if 'IMDb' in series['ExternalUrls'] else None
 
 
+def api_get(path: str, **query):
+    """GET something from Jellyfin's API, reusing this thread's keep-alive connection to the server."""
+    url = urllib.parse.urljoin(args.base_url, path)
+    if query:
+        url += ('&' if '?' in url else '?') + urllib.parse.urlencode(query)
+    split_url = urllib.parse.urlsplit(url)
+    request_path = split_url.path + ('?' + split_url.query if split_url.query else '')
+
+    global request_count
+    with _request_count_lock:
+        request_count += 1
+
+    # Try again with a fresh connection if the server has closed the old one since it was last used
+    for attempt in range(2):
+        connection = getattr(_connections, 'connection', None)
+        if connection is None:
+            connection_class = (http.client.HTTPSConnection if split_url.scheme == 'https' else
+                                http.client.HTTPConnection)
+            connection = _connections.connection = connection_class(split_url.netloc, timeout=60)
+        try:
+            connection.request('GET', request_path, headers=base_headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, ConnectionError):
+            connection.close()
+            _connections.connection = None
+            if attempt:
+                raise
+        else:
+            break
+
+    if response.status != 200:
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+    return json.loads(body)
+
+
 def print_for_humans(series: dict, missing_series_episodes: list):
     """Human-readable output method for sending in emails."""
     # FIXME: Theoretically this URL belongs inside Jellyfin, but that requires a whole plugin and I CBFed
@@ -58,8 +112,8 @@ def print_for_humans(series: dict, missing_series_episodes: list):
               sep=' - ')
 
 
-def print_for_homeassistant(series: dict, missing_series_episodes: list):
-    """Machine-readable output method for use with Home Assistant's command line sensor."""
+def homeassistant_item(series: dict, missing_series_episodes: list):
+    """Item for Home Assistant's upcoming-media-card."""
     # We only actually care about one per show for this output
     episode = missing_series_episodes[0]
 
@@ -91,8 +145,32 @@ def print_for_homeassistant(series: dict, missing_series_episodes: list):
         "stream_url": None,  # This will never be usable as we are specifically getting missing episodes
         "info_url": urllib.parse.urljoin(args.home_assistant, f"web/index.html#!/details?id={episode['Id']}"),
     }
-
-    json.dump(item, sys.stdout)
+    return item
+
+
+def write_homeassistant_json(items, file):
+    """
+    Machine-readable output method for use with Home Assistant's command line sensor.
+    Each item is written as it comes, and the JSON is always closed off properly, even if something fails part way through.
+    """
+    file.write('{"data": [')
+    # Always at least this, so there's never an empty list
+    file.write(json.dumps(HOMEASSISTANT_DEFAULTS))
+    try:
+        for item in items:
+            file.write(', ')
+            file.write(json.dumps(item))
+            file.flush()
+    finally:
+        file.write(']}\n')
+        file.flush()
+
+
+def write_ndjson(items, file):
+    """Same items as write_homeassistant_json(), but one per line for piping into other things."""
+    for item in items:
+        file.write(json.dumps(item) + '\n')
+        file.flush()
 
 
 argparser = argparse.ArgumentParser(description=__doc__)
@@ -110,8 +188,40 @@ group.add_argument('--token', type=str,
                    help="Jellyfin API key to use")
 group.add_argument('--token-file', type=pathlib.Path,
                    help="File handle to get the Jellyfin API key from")
+argparser.add_argument('--jobs', type=int, default=8,
+                       help="How many requests to have in flight at once")
+argparser.add_argument('--bulk', action='store_true',
+                       help="Page through every episode in the library in large requests, rather than a request per series")
+argparser.add_argument('--page-size', type=int, default=2000,
+                       help="How many episodes to get in each request with --bulk")
+argparser.add_argument('--cache', type=pathlib.Path,
+                       help="JSON file to keep the library state in between runs, so later runs only ask for what changed")
+argparser.add_argument('--cache-max-age', type=float, default=24,
+                       help="Hours between full rescans with --cache, which pick up deleted items")
+argparser.add_argument('--stats', action='store_true',
+                       help="Print how many requests were made and how long it all took to stderr, for comparing --bulk")
+argparser.add_argument('--daemon', action='store_true',
+                       help=("Keep running, publishing the --home-assistant output to a retained MQTT topic "
+                             "whenever a webhook or --poll-interval finds something changed"))
+argparser.add_argument('--webhook-port', type=int,
+                       help="Port to listen for Jellyfin's webhook plugin on with --daemon, POSTing anything triggers an update")
+argparser.add_argument('--poll-interval', type=float, default=15 * 60,
+                       help="Seconds between checking for changes with --daemon, even without a webhook")
+argparser.add_argument('--mqtt-host', type=str,
+                       help="MQTT broker for --daemon, looked up via DNS SRV records if not given")
+argparser.add_argument('--mqtt-port', type=int, default=1883,
+                       help="MQTT broker's port")
+argparser.add_argument('--mqtt-topic', type=str, default='jellyfin/missing_episodes',
+                       help="Retained MQTT topic to publish the Home Assistant sensor's JSON to")
+argparser.add_argument('--ndjson', action='store_true',
+                       help="With --home-assistant, output each item on its own line instead of as one big JSON object")
 
 args = argparser.parse_args()
+if args.daemon and not args.home_assistant:
+    argparser.error("--daemon needs --home-assistant for the image & info URLs")
+if args.ndjson and not args.home_assistant:
+    argparser.error("--ndjson needs --home-assistant for the image & info URLs")
+start_time = time.monotonic()
 
 if args.token:
     if not args.home_assistant:
@@ -122,99 +232,294 @@ else:
         api_key = token_file.read().strip()
 
 
-endpoint_url = urllib.parse.urljoin(args.base_url, 'Items')
-
 base_headers = {'accept': 'application/json', 'X-Emby-Token': api_key}
-
-users_req = urllib.request.Request(urllib.parse.urljoin(args.base_url, 'Users?isHiden=False&isDisabled=False'),
-                                   headers={'accept': 'application/json', 'X-Emby-Token': api_key}, method='GET')
-with urllib.request.urlopen(users_req) as users_resp:
-    users = json.loads(users_resp.read())
+# Each worker thread keeps its own connection open between requests
+_connections = threading.local()
+request_count = 0
+_request_count_lock = threading.Lock()
+# FIXME: Jellyfin copes fine with more than this, but let's not hammer it
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+
+# Everything needed to pick up where the last scan left off, and what's kept in the --cache file:
+# {'version': CACHE_VERSION,
+#  'last_run': When the last scan started, as Jellyfin wants it for MinDateLastSaved,
+#  'full_scan': When the last full rescan was, as a Unix timestamp,
+#  'played': {user ID: {played episode ID: series ID}},
+#  'series': {continuing series ID: series},
+#  'episodes': {active series ID: [episode, ...]}}
+def new_state():
+    return {'version': CACHE_VERSION, 'last_run': None, 'full_scan': None, 'played': {}, 'series': {}, 'episodes': {}}
+
+
+def state_expired(state):
+    """Whether it's time for a full rescan, to pick up anything that's been deleted."""
+    return state['full_scan'] is not None and time.time() - state['full_scan'] > args.cache_max_age * 60 * 60
+
+
+def load_cache(path):
+    """Load the state from the last run, or a fresh one if there isn't any or it's due for a full rescan."""
+    if path is None or not path.exists():
+        return new_state()
+    try:
+        state = json.loads(path.read_text())
+    except ValueError:
+        print(f"WARNING: Ignoring corrupt cache file {path}", file=sys.stderr)
+        return new_state()
+    if state.get('version') != CACHE_VERSION or state_expired(state):
+        return new_state()
+    return state
+
+
+def save_cache(path, state):
+    # Written somewhere else first so a crash halfway through doesn't leave a broken cache
+    new_cache_file = path.with_name(path.name + '.new')
+    new_cache_file.write_text(json.dumps(state))
+    new_cache_file.replace(path)
+
+
+def get_user_ids():
+    users = api_get('Users', isHiden=False, isDisabled=False)
     if not args.user:
-        user_ids = set(u['Id'] for u in users if u['HasPassword'])
+        return sorted(u['Id'] for u in users if u['HasPassword'])
     else:
-        user_ids = set(u['Id'] for u in users if u['Name'].lower() in args.user)
+        return sorted(u['Id'] for u in users if u['Name'].lower() in args.user)
+
+
+def played_episode_ids(state):
+    return set(itertools.chain.from_iterable(state['played'].values()))
+
+
+def active_series(state):
+    """Series IDs that have had any episodes watched, and have a status of "continuing"."""
+    return set(itertools.chain.from_iterable(played.values() for played in state['played'].values())) & state['series'].keys()
+
+
+def sorted_series(state, series_ids):
+    """Sort series IDs by name, in a consistent order so the output doesn't shuffle between runs."""
+    return sorted(series_ids, key=lambda series_id: (state['series'][series_id]['Name'], series_id))
+
 
 ###
 ### Get relevant user's played episodes and active series
 ###
-active_series = set()
-all_played_ids = set()
-for user in user_ids:
-    user_played_query_str = urllib.parse.urlencode(dict(includeItemTypes='Episode',
-                                                        fields='Id,SeriesId',
-                                                        IsPlayed=True,
-                                                        userId=user,
-                                                        recursive=True,
-                                                        enableImages=False))
-    with urllib.request.urlopen(urllib.request.Request(endpoint_url + '?' + user_played_query_str,
-                                                       headers=base_headers, method='GET')) as user_played_response:
-        for ep in json.loads(user_played_response.read().decode())['Items']:
-            all_played_ids.add(ep['Id'])
-            active_series.add(ep['SeriesId'])
+def update_played(state, user_ids, since):
+    """Update each user's played episodes, returning the IDs of any series that had episodes change."""
+    def get_user_played(user):
+        """Get {played episode ID: series ID} for the user, only asking about changes if they're already known."""
+        if since is None or user not in state['played']:
+            return {ep['Id']: ep['SeriesId'] for ep in api_get('Items', includeItemTypes='Episode',
+                                                                 fields='Id,SeriesId',
+                                                                 IsPlayed=True,
+                                                                 userId=user,
+                                                                 recursive=True,
+                                                                 enableImages=False)['Items']}
+
+        played = dict(state['played'][user])
+        # Includes anything marked unplayed since, so can't filter on IsPlayed here
+        for ep in api_get('Items', includeItemTypes='Episode',
+                          fields='Id,SeriesId',
+                          MinDateLastSavedForUser=since,
+                          userId=user,
+                          recursive=True,
+                          enableImages=False)['Items']:
+            if ep.get('UserData', {}).get('Played'):
+                played[ep['Id']] = ep['SeriesId']
+            else:
+                played.pop(ep['Id'], None)
+        return played
+
+    old_played = set(itertools.chain.from_iterable(played.items() for played in state['played'].values()))
+    state['played'] = dict(zip(user_ids, executor.map(get_user_played, user_ids)))
+    new_played = set(itertools.chain.from_iterable(played.items() for played in state['played'].values()))
+    return {series_id for _, series_id in old_played ^ new_played}
+
 
 ###
 ### Drop any series that are not still going
 ###
-continuing_series_query = urllib.parse.urlencode(dict(includeItemTypes='Series',  # Don't want episode items here
-                                                      seriesStatus='Continuing',  # Don't care about ended series
-                                                      fields='ExternalUrls',  # For IMDB IDs
-                                                      enableImages=False,
-                                                      recursive=True))
-continuing_series_req = urllib.request.Request(endpoint_url + f'?userId={USER_WITH_MISSING}&' + continuing_series_query,
-                                               headers=base_headers,
-                                               method='GET')
-with urllib.request.urlopen(continuing_series_req) as continuing_series_resp:
-    series_data = {series['Id']: series for series in json.loads(continuing_series_resp.read())['Items']}
-    active_series.intersection_update(series['Id'] for series in series_data.values())
-
-# At this point 'active_series' is only series IDs that have had any episodes watched, and have a status of "continuing"
+def get_series(status, **query):
+    return api_get('Items', userId=USER_WITH_MISSING,
+                   includeItemTypes='Series',  # Don't want episode items here
+                   seriesStatus=status,
+                   fields='ExternalUrls',  # For IMDB IDs
+                   enableImages=False,
+                   recursive=True, **query)['Items']
+
+
+def update_series(state, since):
+    """Update the continuing series, returning the IDs of any that changed."""
+    if since is None:
+        # Don't care about ended series
+        state['series'] = {series['Id']: series for series in get_series('Continuing')}
+        return set(state['series'])
+
+    changed = {series['Id']: series for series in get_series('Continuing', MinDateLastSaved=since)}
+    state['series'].update(changed)
+    for series in get_series('Ended', MinDateLastSaved=since):
+        if state['series'].pop(series['Id'], None):
+            changed[series['Id']] = series
+    return set(changed)
+
 
 ###
 ### Get *all* episodes for each active series
 ###
-# FIXME: This is horrible
-if args.home_assistant:
-    print('{"data": [')
-    json.dump({'title_default': '$title',
-               'line1_default': '$number - $episode',
-               'line2_default': '$release',
-               'line3_default': '$rating',
-               'line4_default': '$studio',
-               'icon': 'mdi:arrow-down-bold-circle'}, sys.stdout)
-
-series_episodes_query = urllib.parse.urlencode(dict(includeItemTypes='Episode',  # Only want episodes
-                                                    fields='Path',  # To determine if we already have it
-                                                    enableImages=False,
-                                                    enableUserData=False,
-                                                    recursive=True))
-for series_id in active_series:
-    series = series_data[series_id]
-    series_url = urllib.parse.urljoin(endpoint_url,
-                                      f'Shows/{series_id}/Episodes?userId={USER_WITH_MISSING}&' + series_episodes_query)
-    series_episodes_req = urllib.request.Request(series_url, headers=base_headers, method='GET')
-    with urllib.request.urlopen(series_episodes_req) as series_episodes_resp:
-        series_episodes = json.loads(series_episodes_resp.read())['Items']
-
-    # Change the PremiereDate field into a more useful object type
-    for episode in series_episodes:
-        episode['PremiereDate'] = datetime.datetime.strptime(episode.get(
-            'PremiereDate', f'{datetime.MAXYEAR}-12-31T00:00:00.0000000Z'), '%Y-%m-%dT%H:%M:%S.%f0Z').date()
+def get_series_episodes(series_id):
+    return api_get(f'Shows/{series_id}/Episodes', userId=USER_WITH_MISSING,
+                   includeItemTypes='Episode',  # Only want episodes
+                   fields='Path',  # To determine if we already have it
+                   enableImages=False,
+                   enableUserData=False,
+                   recursive=True)['Items']
+
+
+def iter_series_episodes(series_ids):
+    """Yield (series ID, episodes) for each series, with a request per series."""
+    # Fetched concurrently, but yielded in the same order they were asked for
+    yield from zip(series_ids, executor.map(get_series_episodes, series_ids))
+
+
+def iter_episodes(**query):
+    """Yield every episode matching the query, a page at a time."""
+    def get_page(start_index):
+        return api_get('Items', userId=USER_WITH_MISSING,
+                       includeItemTypes='Episode',
+                       fields='Path,PremiereDate',
+                       startIndex=start_index, limit=args.page_size,
+                       enableTotalRecordCount=False,
+                       enableImages=False,
+                       enableUserData=False,
+                       recursive=True, **query)['Items']
+
+    # Always have the next page on its way while the current one is being dealt with
+    next_page = executor.submit(get_page, 0)
+    start_index = 0
+    while True:
+        page = next_page.result()
+        start_index += len(page)
+        if len(page) == args.page_size:
+            next_page = executor.submit(get_page, start_index)
+        yield from page
+        if len(page) < args.page_size:
+            return
+
+
+def count_episodes():
+    """How many episodes are in the library, without actually getting any of them."""
+    return api_get('Items', userId=USER_WITH_MISSING,
+                   includeItemTypes='Episode',
+                   limit=0,
+                   recursive=True)['TotalRecordCount']
+
+
+def iter_bulk_series_episodes(series_ids):
+    """
+    Yield (series ID, episodes) for each series, paging through every episode in the library a few large requests at a time.
+    Only the given series' episodes are kept, not the whole library.
+    """
+    # FIXME: /Items can only filter by a single ParentId, so this walks every series' episodes and throws away the inactive ones.
+    total = executor.submit(count_episodes)
+    seen_ids = set()
+    # {series ID: {episode ID: episode}}
+    series_episodes = {series_id: {} for series_id in series_ids}
+    # None of Jellyfin's sort options are unique, so episodes that tie can move between pages from one request to the next.
+    # Hence bucketing them by series rather than counting on each series coming back in one run,
+    # and by ID so any that come back twice only count once.
+    for episode in iter_episodes(sortBy='SeriesSortName,ParentIndexNumber,IndexNumber'):
+        seen_ids.add(episode['Id'])
+        if episode.get('SeriesId') in series_episodes:
+            series_episodes[episode['SeriesId']][episode['Id']] = episode
+
+    if len(seen_ids) != total.result():
+        # Some got skipped by the shuffling, or the library changed part way through
+        print(f"Only got {len(seen_ids)} of {total.result()} episodes paging through them all,",
+              "getting each series' separately instead", file=sys.stderr)
+        yield from iter_series_episodes(series_ids)
+        return
+    for series_id, episodes in series_episodes.items():
+        yield series_id, list(episodes.values())
+
+
+def iter_fetch_series_episodes(series_ids):
+    if not series_ids:
+        return iter(())
+    return iter_bulk_series_episodes(series_ids) if args.bulk else iter_series_episodes(series_ids)
+
+
+def iter_cached_series_episodes(state, series_ids, since, changed_series=None):
+    """
+    Yield (series ID, episodes) for each series, updating the cached episodes with whatever's changed since the last scan.
+    Only series that aren't cached yet get fetched in full.
+    If changed_series is given, cached series are only yielded if they're in it or had any episodes change.
+    """
+    cached_episodes = {series_id: {episode['Id']: episode for episode in state['episodes'][series_id]}
+                       for series_id in series_ids if series_id in state['episodes']}
+    changed_series = set(cached_episodes) if changed_series is None else set(changed_series)
+    for episode in iter_episodes(MinDateLastSaved=since):
+        if episode.get('SeriesId') in cached_episodes:
+            cached_episodes[episode['SeriesId']][episode['Id']] = episode
+            changed_series.add(episode['SeriesId'])
+    for series_id, episodes in cached_episodes.items():
+        if series_id in changed_series:
+            yield series_id, list(episodes.values())
+
+    yield from iter_fetch_series_episodes([series_id for series_id in series_ids if series_id not in cached_episodes])
+
+
+def scan(state, keep_episodes=False, only_changed=False):
+    """
+    Bring the state up to date with Jellyfin, only asking about what's changed since the last scan if there's been one.
+    Returns an iterator of (series ID, episodes) for the active series, which fetches them as it goes,
+    only keeping them in the state if keep_episodes.
+    With only_changed, series already in the state that haven't changed are skipped.
+    """
+    since = state['last_run']
+    this_run = (datetime.datetime.now(datetime.timezone.utc) - CACHE_CLOCK_SLACK).strftime('%Y-%m-%dT%H:%M:%SZ')
+    this_scan = time.time()
+
+    changed_series = update_played(state, get_user_ids(), since)
+    changed_series |= update_series(state, since)
+    series_ids = sorted_series(state, active_series(state))
+
+    # Forget about anything that's not active anymore
+    for series_id in state['episodes'].keys() - set(series_ids):
+        del state['episodes'][series_id]
+
+    if since is None:
+        series_episodes_iter = iter_fetch_series_episodes(series_ids)
+    else:
+        series_episodes_iter = iter_cached_series_episodes(state, series_ids, since,
+                                                           changed_series if only_changed else None)
+    for series_id, series_episodes in series_episodes_iter:
+        if keep_episodes:
+            state['episodes'][series_id] = series_episodes
+        yield series_id, series_episodes
+
+    # Only once it's all done, so if anything fails the next scan asks for the same changes again
+    state['last_run'] = this_run
+    if since is None:
+        state['full_scan'] = this_scan
+
+
+def find_missing_episodes(series_episodes: list, played_ids: set):
+    """Find the aired episodes that are missing and haven't been watched, after the last one that isn't."""
+    # Change the PremiereDate field into a more useful object type, without touching the original that might get cached
+    series_episodes = [dict(episode, PremiereDate=datetime.datetime.strptime(episode.get(
+        'PremiereDate', f'{datetime.MAXYEAR}-12-31T00:00:00.0000000Z'), '%Y-%m-%dT%H:%M:%S.%f0Z').date())
+                       for episode in series_episodes]
 
     # Sort the list in reverse PremiereDate and remove "future" episodes
-    series_episodes = sorted([ep for ep in series_episodes if ep['PremiereDate'] <= TODAY],
+    today = datetime.datetime.now().date()
+    series_episodes = sorted([ep for ep in series_episodes if ep['PremiereDate'] <= today],
                              key=lambda ep: (ep['PremiereDate'], ep['ParentIndexNumber'], ep.get('IndexNumber', 0)),
                              reverse=True)  # In reverse so we can start from the newest and work backwards until we stop
 
-    ###
-    ### Find the missing episodes for this series
-    ###
     missing_series_episodes = []
     for episode in series_episodes:
         # Ignore special episodes from the list if we don't care on this run
         if args.ignore_specials and episode['ParentIndexNumber'] == 0 and episode['SeasonName'] == 'Specials':
             continue
-        elif 'Path' not in episode and episode['Id'] not in all_played_ids:
+        elif 'Path' not in episode and episode['Id'] not in played_ids:
             # This episode is missing and has not been watched by any users.
             #
             # Insert to the beginning of the list to invert the reversed sort.
@@ -225,13 +530,156 @@ for series_id in active_series:
             # Stop scanning here and assume everything older has been seen.
             # This way season 1 can be deleted while watching season 2 without constant pestering that season 1 is missing
             break
+    return missing_series_episodes
+
 
-    if missing_series_episodes and not args.home_assistant:
+###
+### Find the missing episodes for each series
+###
+def iter_scan_missing_episodes(state, keep_episodes=False, only_changed=False):
+    """Scan Jellyfin, yielding (series ID, missing episodes) as each series' episodes come in."""
+    series_episodes_iter = scan(state, keep_episodes=keep_episodes, only_changed=only_changed)
+    # scan() has updated the played episodes before fetching any episodes
+    played_ids = None
+    for series_id, series_episodes in series_episodes_iter:
+        if played_ids is None:
+            played_ids = played_episode_ids(state)
+        yield series_id, find_missing_episodes(series_episodes, played_ids)
+
+
+def iter_sorted_missing_episodes(state, keep_episodes=False):
+    """
+    Scan Jellyfin, yielding (series, missing episodes) in the same order as iter_missing_episodes().
+    Fetching doesn't always give the series back in that order (cached series come first, --bulk goes by Jellyfin's sort name),
+    so any that arrive early wait for the ones before them, only holding on to their missing episodes.
+    """
+    series_ids = None
+    early = {}
+    for series_id, missing_series_episodes in iter_scan_missing_episodes(state, keep_episodes=keep_episodes):
+        if series_ids is None:
+            # scan() has worked out which series are active by now
+            series_ids = iter(sorted_series(state, active_series(state)))
+            next_series_id = next(series_ids, None)
+        early[series_id] = missing_series_episodes
+        while next_series_id in early:
+            missing_series_episodes = early.pop(next_series_id)
+            if missing_series_episodes:
+                yield state['series'][next_series_id], missing_series_episodes
+            next_series_id = next(series_ids, None)
+
+    # Anything that came back without an episode for whichever series it was waiting on
+    for series_id in sorted_series(state, early):
+        if early[series_id]:
+            yield state['series'][series_id], early[series_id]
+
+
+def update_missing(state, missing_episodes, keep_episodes=False, only_changed=False):
+    """Scan Jellyfin and update {series ID: missing episodes} for whichever series might have changed."""
+    for series_id, missing_series_episodes in iter_scan_missing_episodes(state, keep_episodes, only_changed):
+        if missing_series_episodes:
+            missing_episodes[series_id] = missing_series_episodes
+        else:
+            missing_episodes.pop(series_id, None)
+
+    for series_id in missing_episodes.keys() - active_series(state):
+        del missing_episodes[series_id]
+
+
+def iter_missing_episodes(state, missing_episodes):
+    """Yield (series, missing episodes) in a consistent order, so the output doesn't shuffle between runs."""
+    for series_id in sorted_series(state, missing_episodes):
+        yield state['series'][series_id], missing_episodes[series_id]
+
+
+def homeassistant_payload(state, missing_episodes):
+    """The whole upcoming-media-card sensor, as JSON."""
+    payload = io.StringIO()
+    write_homeassistant_json((homeassistant_item(series, missing_series_episodes)
+                              for series, missing_series_episodes in iter_missing_episodes(state, missing_episodes)),
+                             payload)
+    return payload.getvalue()
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Any POST at all just means "something changed", the scan figures out what."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(204)
+        self.end_headers()
+        self.server.wake.set()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_daemon():
+    """Keep the library in memory, updating it & publishing to MQTT whenever Jellyfin says something changed."""
+    # Only needed here, so the one-shot mode doesn't need paho & friends
+    import hass_mqtt
+
+    bridge = hass_mqtt.MQTTBridge(f'{args.mqtt_topic}/availability', host=args.mqtt_host, port=args.mqtt_port)
+    bridge.connect_async()
+    bridge.loop_start()
+
+    wake = threading.Event()
+    if args.webhook_port:
+        webhook_server = http.server.ThreadingHTTPServer(('', args.webhook_port), WebhookHandler)
+        webhook_server.wake = wake
+        threading.Thread(target=webhook_server.serve_forever, name='webhook', daemon=True).start()
+
+    state = load_cache(args.cache)
+    missing_episodes = {}
+    # Everything needs working out the first time, and again each day as episodes air
+    checked_date = None
+    payload = None
+    while True:
+        if state_expired(state):
+            state = new_state()
+            missing_episodes = {}
+        today = datetime.datetime.now().date()
+        try:
+            update_missing(state, missing_episodes, keep_episodes=True, only_changed=checked_date == today)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            print(f"Failed to update from Jellyfin: {e}", file=sys.stderr, flush=True)
+            # Some of the changes might've been recorded without the missing episodes being worked out from them
+            checked_date = None
+        else:
+            checked_date = today
+            if args.cache:
+                save_cache(args.cache, state)
+            new_payload = homeassistant_payload(state, missing_episodes)
+            if new_payload != payload:
+                payload = new_payload
+                bridge.publish(args.mqtt_topic, payload, retain=True)
+            bridge.set_available(True)
+
+        if wake.wait(args.poll_interval):
+            # Webhooks tend to come in bursts while Jellyfin's scanning the library, let it settle first
+            time.sleep(WEBHOOK_SETTLE_SECONDS)
+            wake.clear()
+
+
+if args.daemon:
+    run_daemon()
+
+state = load_cache(args.cache)
+# Each series is output as soon as it and every series before it have come in,
+# and episodes are only kept around if they're going in the cache, so this stays small however big the library is
+missing = iter_sorted_missing_episodes(state, keep_episodes=bool(args.cache))
+if not args.home_assistant:
+    for series, missing_series_episodes in missing:
         print_for_humans(series, missing_series_episodes)
-    elif missing_series_episodes and args.home_assistant:
-        print(', ')
-        print_for_homeassistant(series, missing_series_episodes)
+else:
+    items = (homeassistant_item(series, missing_series_episodes) for series, missing_series_episodes in missing)
+    if args.ndjson:
+        write_ndjson(items, sys.stdout)
+    else:
+        write_homeassistant_json(items, sys.stdout)
+
+# Only once everything's worked, otherwise the next run should start from the last good state
+if args.cache:
+    save_cache(args.cache, state)
 
-# FIXME: This is horrible
-if args.home_assistant:
-    print(']}')
+if args.stats:
+    print(f"{request_count} requests in {time.monotonic() - start_time:.2f} seconds", file=sys.stderr)
@@ -1,20 +1,15 @@
 #!/usr/bin/python3
 """Connect screensaver state to Home Assistant."""
 import sys
-import dns.resolver
-import json
 import socket
-import subprocess
-import uuid
 import typing
 
 import paho.mqtt.client
+import hass_mqtt
 import dbus
 from gi.repository import GLib
 from dbus.mainloop.glib import DBusGMainLoop
 
-# FIXME: Make async I/O work
-
 # FIXME: Set up Home Assistant's MQTT discovery per:
 #        https://www.home-assistant.io/integrations/mqtt/#mqtt-discovery
 #        Instead of relying on a single static topic.
@@ -30,116 +25,109 @@ AVAILABILITY_TOPIC = '/'.join((MQTT_TOPIC_BASE, "availability"))
 
 
 
-def mqtt_discovery(mqtt_client):
+def mqtt_discovery(bridge: hass_mqtt.MQTTBridge, session):
     """Send MQTT discovery info for Home Assistant."""
     # FIXME: Why do the DLNA & Nmap devices combine into one, but I can't make this combine with them?
-    mac_address = f'{uuid.getnode():02x}'
-    unique_id = ':'.join(mac_address[i:i + 2] for i in range(0, len(mac_address), 2))
-
-    mqtt_client.publish(topic='/'.join((MQTT_TOPIC_BASE, "config")),
-                        payload=json.dumps({
-                            "availability_topic": AVAILABILITY_TOPIC,
-                            "device": {
-                                "connections": [("mac", unique_id)],
-                                "name": socket.gethostname()},
-                            "unique_id": f'screensaver_mqtt:{uuid.getnode():02x}',
-                            # "category": "config/diagnostic",  # FIXME: wtf is this?
-                            "icon": "mdi:monitor-lock",
-                            # FIXME: Not currently sending attributes anywhere
-                            "json_attributes_topic": '/'.join((MQTT_TOPIC_BASE, "attributes")),
-                            "name": "Screensaver",
-                            "state_topic": '/'.join((MQTT_TOPIC_BASE, "state")),
-                            "command_topic": '/'.join((MQTT_TOPIC_BASE, "command")),
-                            "command_template": '{{ value }}{% if code is not none %} {{ code }}{% endif %}',
-                            "code_format": r"^(\d+|.+)?$",
-                            "retain": False,  # Tells Home Assistant to NOT mark commands for retainment in mqtt
-                        }),
-                        retain=True)
-
-    return '/'.join((MQTT_TOPIC_BASE, "state")), '/'.join((MQTT_TOPIC_BASE, "command"))
-
-
-# Since upstream **still** hasn't fixed this 3yr old bug
-# https://github.com/eclipse/paho.mqtt.python/issues/493
-# I've copy/pasted upstream's connect_srv function to fix it internally.
-# I've also pushed my own pull request for them
-# https://github.com/eclipse/paho.mqtt.python/pull/759
-# but I get the feeling it's going to be ignored
-# -- mijofa, 2023-10-23
-def connect_srv(mqtt_client, domain=None, *args, **kwargs):
-    """Connect to a remote broker.
-
-    domain is the DNS domain to search for SRV records; if None,
-    try to determine local domain name.
-    All other args are used as is for connect()
+    unique_id = hass_mqtt.mac_address()
+
+    bridge.publish_discovery(topic='/'.join((session.topic_base, "config")),
+                             config={
+                                 # Both the whole service, and this specific session, need to be available
+                                 "availability": [{"topic": AVAILABILITY_TOPIC},
+                                                  {"topic": session.availability_topic}],
+                                 "availability_mode": "all",
+                                 "device": {
+                                     "connections": [("mac", unique_id)],
+                                     "name": socket.gethostname()},
+                                 "unique_id": f'screensaver_mqtt:{hass_mqtt.node_id()}:{session.slot}',
+                                 # "category": "config/diagnostic",  # FIXME: wtf is this?
+                                 "icon": "mdi:monitor-lock",
+                                 # FIXME: Not currently sending attributes anywhere
+                                 "json_attributes_topic": '/'.join((session.topic_base, "attributes")),
+                                 "name": f"Screensaver ({session.user} on {session.seat or 'no seat'})",
+                                 "state_topic": session.state_topic,
+                                 "command_topic": session.command_topic,
+                                 "command_template": '{{ value }}{% if code is not none %} {{ code }}{% endif %}',
+                                 "code_format": r"^(\d+|.+)?$",
+                                 "retain": False,  # Tells Home Assistant to NOT mark commands for retainment in mqtt
+                             })
+
+
+class GLibMQTTHelper:
+    """Drive paho's socket from the GLib main loop instead of its own loop_start() thread.
+
+    This keeps the MQTT callbacks on the same thread as everything else, so they can safely make D-Bus calls.
     """
-    if domain is None:
-        domain = socket.getfqdn()
-        domain = domain[domain.find('.') + 1:]
-
-    try:
-        rr = '_mqtt._tcp.%s' % domain
-        if mqtt_client._ssl:
-            # IANA specifies secure-mqtt (not mqtts) for port 8883
-            rr = '_secure-mqtt._tcp.%s' % domain
-        answers = []
-        for answer in dns.resolver.resolve(rr, dns.rdatatype.SRV):
-            addr = answer.target.to_text()[:-1]
-            answers.append(
-                (addr, answer.port, answer.priority, answer.weight))
-    except (dns.resolver.NXDOMAIN,
-            dns.resolver.NoAnswer,
-            dns.resolver.NoNameservers):
-        raise ValueError("No answer/NXDOMAIN for SRV in %s" % (domain))
-
-    # FIXME: doesn't account for weight
-    for answer in answers:
-        host, port, prio, weight = answer
 
+    def __init__(self, bridge: hass_mqtt.MQTTBridge):
+        self.bridge = bridge
+        self.client = client = bridge.client
+        self._read_source: int | None = None
+        self._write_source: int | None = None
+        self._misc_source: int | None = None
+        # NOTE: The socket callbacks must be set before connecting.
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def start(self):
+        """Connect (retrying in the background if that fails) and start the heartbeats."""
+        self.reconnect()
+        GLib.timeout_add_seconds(int(self.bridge.heartbeat_interval), lambda: self.bridge.heartbeat() or True)
+
+    @staticmethod
+    def _remove(source: int | None) -> None:
+        if source is not None:
+            GLib.source_remove(source)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._read_source = GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                                              lambda fd, condition: self.client.loop_read() or True)
+        self._misc_source = GLib.timeout_add_seconds(1, self._on_misc)
+
+    def _on_misc(self):
+        """Handle keepalives & retries, like the rest of paho's loop() would."""
+        if self.client.loop_misc() == paho.mqtt.client.MQTT_ERR_SUCCESS:
+            return True
+        # GLib will remove the source itself when we return False
+        self._misc_source = None
+        return False
+
+    def on_socket_close(self, client, userdata, sock):
+        self._read_source = self._remove(self._read_source)
+        self._write_source = self._remove(self._write_source)
+        self._misc_source = self._remove(self._misc_source)
+        # loop_start() would've reconnected for us
+        GLib.timeout_add(int(self.bridge.next_reconnect_delay() * 1000), self.reconnect)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        if self._write_source is None:
+            self._write_source = GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_OUT,
+                                                   lambda fd, condition: self.client.loop_write() or True)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._write_source = self._remove(self._write_source)
+
+    def reconnect(self):
         try:
-            return mqtt_client.connect(host, port, *args, **kwargs)
-        except Exception:
-            raise
-
-    raise ValueError("No SRV hosts responded")
-
-
-def command_callback(client, unknown, message):
-    if message.topic != command_topic:
-        raise Exception("Callback called from the wrong topic")
-    command = message.payload.decode().split()
-    print('mqtt>', command[0] if len(command) == 1 else f'{command[0]} [REDACTED]', flush=True)
-    if command[0] == 'LOCK':
-        # FIXME: Should I do anything if a code is provided?
-        # FIXME: '1' is a magic number for the "first" session, how do we avoid this?
-        return login1_manager.LockSession('1')
-    if command[0] == 'UNLOCK':
-        # FIXME: '1' is a magic number for the "first" session, how do we avoid this?
-        # Raising an exception here would kill the mqtt client, we don't want that
-        print(NotImplementedError("FIXME: Think of a good way to unlock with a code"))
-        return login1_manager.ActivateSession('1')
-        # return # login1_manager.UnlockSession('1')
-    else:
-        print('Only locking is supported, or (maybe) unlocking with a code. Recieved', command, file=sys.stderr)
-        return
-
+            self.bridge.connect()
+        except (OSError, ValueError) as e:
+            delay = self.bridge.next_reconnect_delay()
+            print(f"MQTT connection failed, retrying in {delay:.1f}s:", e, file=sys.stderr, flush=True)
+            GLib.timeout_add(int(delay * 1000), self.reconnect)
+        # Always a one-off timeout, the next one's delay is different
+        return False
 
-mqtt_client = paho.mqtt.client.Client()
-# NOTE: The will must be set before connecting.
-mqtt_client.will_set(topic=AVAILABILITY_TOPIC, payload='offline')
 
-# FIXME: Try anonymous, and fallback on guest:guest when that fails
-mqtt_client.username_pw_set(username='guest', password='guest')
-connect_srv(mqtt_client)
-mqtt_client.loop_start()
+bridge = hass_mqtt.MQTTBridge(AVAILABILITY_TOPIC)
+GLibMQTTHelper(bridge).start()
 
 # FIXME: Notify Systemd that we're ready
-state_topic, command_topic = mqtt_discovery(mqtt_client)
+# Clear out the single entity that was used before sessions were tracked separately
+bridge.clear_discovery('/'.join((MQTT_TOPIC_BASE, "config")))
 
-mqtt_client.message_callback_add(sub=command_topic, callback=command_callback)
-mqtt_client.subscribe(topic=command_topic)
-
-# FIXME: Is this likely to conflict with the mqtt loop? Can we cleanup & connect them together regardless?
+# MQTT is driven from this same main loop, so everything happens on the one thread.
 DBusGMainLoop(set_as_default=True)
 loop = GLib.MainLoop()
 
@@ -167,65 +155,228 @@ login1_manager = dbus.Interface(login1, "org.freedesktop.login1.Manager")
 #
 # login1.connect_to_signal(signal_name='PropertiesChanged', handler_function=f, dbus_interface='org.freedesktop.DBus.Properties')
 
-IdleHint: bool | None = None
-LockedHint: bool | None = None
+class Session:
+    """
+    A logind session, and the Home Assistant lock entity for it if it's graphical.
+    The entity belongs to the user & seat rather than the session, since logind gives every login a new session ID,
+    so it's the same entity from one login to the next.
+    """
+
+    GRAPHICAL_TYPES = ('x11', 'wayland', 'mir')
+
+    def __init__(self, session_id: str, object_path: str):
+        self.id = str(session_id)
+        self.path = str(object_path)
+        # Cached so that commands don't need to look the session up every time
+        self.proxy = bus.get_object("org.freedesktop.login1", self.path)
+        self.interface = dbus.Interface(self.proxy, "org.freedesktop.login1.Session")
+
+        props = self.proxy.GetAll('org.freedesktop.login1.Session', dbus_interface='org.freedesktop.DBus.Properties')
+        self.user = str(props['Name'])
+        self.type = str(props['Type'])
+        # (seat ID, object path), with an empty ID for sessions that aren't on a seat
+        self.seat = str(props['Seat'][0]) or None
+        self.slot = f"{self.user}_{self.seat or 'noseat'}"
+        self.IdleHint: bool | None = bool(props['IdleHint'])
+        self.LockedHint: bool | None = bool(props['LockedHint'])
+
+        self.topic_base = f"{MQTT_TOPIC_BASE}_{self.slot}"
+        self.availability_topic = '/'.join((self.topic_base, "availability"))
+        self.state_topic = '/'.join((self.topic_base, "state"))
+        self.command_topic = '/'.join((self.topic_base, "command"))
+        self.announced = False
+
+    @property
+    def graphical(self) -> bool:
+        return self.type in self.GRAPHICAL_TYPES
+
+    def announce(self):
+        """Set up the Home Assistant entity for this session, if it's graphical."""
+        if self.announced or not self.graphical:
+            return
+        if self.slot in slots:
+            # The same user has another graphical session on this seat, that one keeps the entity until it ends
+            return
+        slots[self.slot] = self
+        self.announced = True
+        mqtt_discovery(bridge, self)
+        bridge.subscribe(self.command_topic, self.command_callback)
+        self.publish_state()
+
+    def remove(self):
+        """Let go of the Home Assistant entity, leaving it unavailable until the user logs in on this seat again."""
+        if not self.announced:
+            return
+        self.announced = False
+        del slots[self.slot]
+        bridge.unsubscribe(self.command_topic)
+        bridge.publish(topic=self.availability_topic, payload='offline', retain=True)
+
+    def command_callback(self, client, unknown, message):
+        command = message.payload.decode().split()
+        print(f'mqtt[{self.id}]>', command[0] if len(command) == 1 else f'{command[0]} [REDACTED]', flush=True)
+        if command[0] == 'LOCK':
+            # FIXME: Should I do anything if a code is provided?
+            return self.interface.Lock()
+        if command[0] == 'UNLOCK':
+            # Raising an exception here would kill the mqtt client, we don't want that
+            print(NotImplementedError("FIXME: Think of a good way to unlock with a code"))
+            return self.interface.Activate()
+            # return # self.interface.Unlock()
+        else:
+            print('Only locking is supported, or (maybe) unlocking with a code. Recieved', command, file=sys.stderr)
+            return
+
+    def update(self, changed_properties: dict[str, typing.Any], invalidated_properties: list[str]):
+        if 'Type' in changed_properties:
+            # Can change when a session on a TTY starts up a graphical compositor
+            self.type = str(changed_properties['Type'])
+            self.announce()
+        if 'IdleHint' in changed_properties:
+            self.IdleHint = bool(changed_properties['IdleHint'])
+        elif 'IdleHint' in invalidated_properties:
+            # I've never actually seen this be invalidated, so I don't think this is possible
+            self.IdleHint = None
+        if 'LockedHint' in changed_properties:
+            self.LockedHint = bool(changed_properties['LockedHint'])
+        elif 'LockedHint' in invalidated_properties:
+            # I've never actually seen this be invalidated, so I don't think this is possible
+            self.LockedHint = None
+
+        if self.announced:
+            self.publish_state(changed_properties)
+
+    def publish_state(self, changed_properties: dict[str, typing.Any] | None = None):
+        changed_properties = changed_properties or {}
+        if self.LockedHint == True and self.IdleHint == False and 'LockedHint' in changed_properties:
+            # Locked before screen blanked? User pressed Super+L to lock the screen
+            payload = 'LOCKING'
+        # elif self.LockedHint == True and self.IdleHint == False and 'IdleHint' in changed_properties:
+        #     # Screen unblanked while locked? User probably pressed a button, or a notification came in
+        #     payload = 'UNLOCKING'
+        elif self.LockedHint == True:
+            payload = 'LOCKED'
+        elif self.LockedHint == False and self.IdleHint == True:
+            # Screen blanked before locked? Idle timeout occurred, we're about to lock
+            payload = 'LOCKING'
+        elif self.LockedHint == False:
+            payload = 'UNLOCKED'
+        else:
+            payload = None
+
+        print(f"{self.id}: {payload}: IDLE={self.IdleHint}, LOCKED={self.LockedHint},",
+              f"CHANGED={[str(k) for k in changed_properties.keys()]}", flush=True)
+
+        # Availability is retained so Home Assistant still knows it after restarting,
+        # the global availability topic's will takes care of marking it unavailable if we die.
+        if payload is not None:
+            bridge.publish(topic=self.availability_topic, payload='online', retain=True)
+            bridge.publish(topic=self.state_topic,
+                           payload=payload,
+                           retain=False)
+        else:
+            # We're confused right now, tell Home Assistant that the state is unreliable
+            # FIXME: Use 'MOTOR_JAMMED' or 'MOTOR_OK' instead?
+            bridge.publish(topic=self.availability_topic, payload='offline', retain=True)
+
+
+# {object path: session}
+sessions: dict[str, Session] = {}
+# {user & seat: the session that has the entity for them}
+slots: dict[str, Session] = {}
+
+
+def handle_session_new(session_id: str, object_path: str):
+    if str(object_path) in sessions:
+        # Already picked up by ListSessions
+        return
+    session = sessions[str(object_path)] = Session(session_id, object_path)
+    print(f"New {session.type} session {session.id} for {session.user}", flush=True)
+    session.announce()
+
+
+def handle_session_removed(session_id: str, object_path: str):
+    if (session := sessions.pop(str(object_path), None)) is not None:
+        print(f"Removed session {session.id}", flush=True)
+        session.remove()
+        # Hand the entity over to any other graphical session the user has on that seat
+        for other in sessions.values():
+            if other.slot == session.slot:
+                other.announce()
+
+
+def handle_stale_availability(client, userdata, message):
+    """Deal with entities whose session ended while we weren't running to see it."""
+    if not message.retain or not message.payload:
+        # Only the retained messages from before we started, not the ones we're publishing now
+        return
+    topic_base = message.topic.rsplit('/', 1)[0]
+    if not topic_base.startswith(f"{MQTT_TOPIC_BASE}_"):
+        # Something else of this host's, like the global availability topic
+        return
+    if any(session.topic_base == topic_base for session in slots.values()):
+        return
+    if '_' not in topic_base[len(MQTT_TOPIC_BASE) + 1:]:
+        # From before entities belonged to the user & seat, when there was one per session ID
+        bridge.clear_discovery('/'.join((topic_base, "config")))
+        bridge.publish(topic=message.topic, payload='', retain=True)
+    elif message.payload != b'offline':
+        bridge.publish(topic=message.topic, payload='offline', retain=True)
+
+
+# How many PropertiesChanged signals got past the bus daemon's bus_name/arg0 matching & woke us up,
+# and how many of those were actually for a session we know about.
+# Whatever the match rule dropped never reaches us, so can't be counted here,
+# `busctl monitor org.freedesktop.login1` or dbus-monitor shows how much that is.
+signal_counts = {'delivered': 0, 'handled': 0}
 
 
 def handle_dbus_property_update(interface: str,
                                 changed_properties: dict[str, typing.Any],
                                 invalidated_properties: list[str],
                                 sender_path: str):
+    signal_counts['delivered'] += 1
     if interface != 'org.freedesktop.login1.Session':
-        # We don't do actually care, but for some reason we couldn't make add_signal_receiver match for this specifically
+        # Shouldn't happen since the bus daemon is filtering on arg0 for us
         return
     assert sender_path.startswith('/org/freedesktop/login1/session'), sender_path
 
-    global IdleHint, LockedHint
-    if 'IdleHint' in changed_properties:
-        IdleHint = bool(changed_properties['IdleHint'])
-    elif 'IdleHint' in invalidated_properties:
-        # I've never actually seen this be invalidated, so I don't think this is possible
-        IdleHint = None
-    if 'LockedHint' in changed_properties:
-        LockedHint = bool(changed_properties['LockedHint'])
-    elif 'LockedHint' in invalidated_properties:
-        # I've never actually seen this be invalidated, so I don't think this is possible
-        LockedHint = None
-
-    if LockedHint == True and IdleHint == False and 'LockedHint' in changed_properties:
-        # Locked before screen blanked? User pressed Super+L to lock the screen
-        payload = 'LOCKING'
-    # elif LockedHint == True and IdleHint == False and 'IdleHint' in changed_properties:
-    #     # Screen unblanked while locked? User probably pressed a button, or a notification came in
-    #     payload = 'UNLOCKING'
-    elif LockedHint == True:
-        payload = 'LOCKED'
-    elif LockedHint == False and IdleHint == True:
-        # Screen blanked before locked? Idle timeout occurred, we're about to lock
-        payload = 'LOCKING'
-    elif LockedHint == False:
-        payload = 'UNLOCKED'
-    else:
-        payload = None
-
-    print(f"{payload}: IDLE={IdleHint}, LOCKED={LockedHint}, CHANGED={[str(k) for k in changed_properties.keys()]}", flush=True)
-
-    if payload is not None:
-        # Remind the mqtt server we're still here, and providing accurate info
-        mqtt_client.publish(topic=AVAILABILITY_TOPIC, payload='online', retain=False)
-        mqtt_client.publish(topic=state_topic,
-                            payload=payload,
-                            retain=False)
-    else:
-        # We're confused right now, tell Home Assistant that the state is unreliable
-        # FIXME: Use 'MOTOR_JAMMED' or 'MOTOR_OK' instead?
-        mqtt_client.publish(topic=AVAILABILITY_TOPIC, payload='offline', retain=False)
-
-
-# FIXME: WTF couldn't I make this work with login1.connect_to_signal?
+    if (session := sessions.get(str(sender_path))) is not None:
+        signal_counts['handled'] += 1
+        session.update(changed_properties, invalidated_properties)
+
+
+def log_signal_counts():
+    print(f"D-Bus signals: delivered={signal_counts['delivered']}, handled={signal_counts['handled']}", flush=True)
+    # Keep the timeout going
+    return True
+
+
+login1_manager.connect_to_signal('SessionNew', handle_session_new)
+login1_manager.connect_to_signal('SessionRemoved', handle_session_removed)
+# Only need to list them once, SessionNew/SessionRemoved will keep us up to date from here on.
+for session_id, _uid, _user_name, _seat_id, object_path in login1_manager.ListSessions():
+    handle_session_new(session_id, object_path)
+# Only once the current sessions are known, so the retained messages can be checked against them
+# MQTT wildcards have to be a whole level, so this gets more than just the screensavers
+bridge.subscribe('/'.join((MQTT_TOPIC_BASE.rsplit('/', 1)[0], "+", "availability")), handle_stale_availability)
+# The bridge keeps reminding the mqtt server we're still here, and providing accurate info, from now on
+bridge.set_available(True)
+
+
+# NOTE: login1.connect_to_signal only matches the manager's own object path, not each session's path,
+#       which is why this needs add_signal_receiver.
+# The bus_name (sender) & arg0 (interface name) keywords become part of the D-Bus match rule,
+# so the bus daemon only wakes us up for logind's session property changes,
+# rather than every PropertiesChanged from NetworkManager, UPower, systemd units, etc.
+# FIXME: A path_namespace='/org/freedesktop/login1/session' match would be nice too,
+#        but dbus-python only passes through argN keywords. The sender match makes it redundant anyway.
 bus.add_signal_receiver(handler_function=handle_dbus_property_update,
                         dbus_interface='org.freedesktop.DBus.Properties',
                         signal_name='PropertiesChanged',
+                        bus_name='org.freedesktop.login1',
+                        arg0='org.freedesktop.login1.Session',
                         path_keyword='sender_path')
+GLib.timeout_add_seconds(60 * 60, log_signal_counts)
 
 loop.run()
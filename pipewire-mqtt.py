@@ -1,50 +1,53 @@
 #!/usr/bin/python3
 """Monitor pipewire state."""
+import argparse
+import asyncio
 import json
+import re
+import signal
 import socket
 import subprocess
 import sys
+import threading
 import typing
-import uuid
 
-import dns.resolver
-import paho.mqtt.client
+import hass_mqtt
 
-# FIXME: Make async I/O work
+# FIXME: The threaded mode is still the default, --asyncio should replace it once it's had more use
 
 # In my experience, the role can be whatever string I want it to be.
 # But in practice, it's barely actually used.
 # And in the documentation there's a limited number of options for it.
 # https://www.freedesktop.org/wiki/Software/PulseAudio/Documentation/Developer/Clients/ApplicationProperties/#pa_prop_media_role
-PW_ROLE_NUM_STREAMS: dict[str, set] = {
+PW_ROLE_NUM_STREAMS: dict[str, int] = {
     # Should be ignored as this is what we're controling anyway.
-    "music": set(),
+    "music": 0,
     # Must mute the music and steal all attention
-    "phone": set(),
+    "phone": 0,
     # Should probably dim the lights the same as TV inhibitor
-    "game": set(),
+    "game": 0,
     # Should this dim the lights? Probably not, this'll be YouTube videos and such
-    "video": set(),
+    "video": 0,
     # Chat notification blips, should this mute the music?
     # Ideally, probably not.
     # Realistically I probably can't differentiate it from 'phone' because I'm setting role at the application level.
-    "notification": set(),
-    "event": set(),
+    "notification": 0,
+    "event": 0,
     # I personally don't expect to use this one currently.
     # It maybe shouldn't mute the music, but maybe lower the music volume.
-    "a11y": set(),
+    "a11y": 0,
     # Wtf, are these ever even gonna be used?
-    "animation": set(),
-    "production": set(),
+    "animation": 0,
+    "production": 0,
     # FIXME: Should this be phone?
     #        This is what I'm seeing with Discord, even though I've set `Environment=PULSE_PROP="media.role=phone"`
     # There is a special hack for dealing with Discord.
     # I don't care if Discord is playing sound, but I do care when I'm talking to Discord.
     # So I treat the 'communication' role special by only inhibiting it when an app is listening for Mic input
-    "communication": set(),
+    "communication": 0,
     # Not a real option, I'm just using this for anything that doesn't have a defined role
     # FIXME: Should probably use this for any roles that are not in this list either
-    'other': set(),
+    'other': 0,
 }
 
 hostname = socket.gethostname().split('.', 1)[0]
@@ -52,225 +55,466 @@ MQTT_TOPIC_BASE: str = f"homeassistant/binary_sensor/{hostname}"
 AVAILABILITY_TOPIC: str = '/'.join((MQTT_TOPIC_BASE, "pipewire_availability"))
 
 
-def mqtt_discovery(client: paho.mqtt.client.Client):
+def state_topic(role: str) -> str:
+    """MQTT state topic for the given role's binary_sensor."""
+    return '/'.join((MQTT_TOPIC_BASE, f"pipewire_{role}", "state"))
+
+
+def attributes_topic(role: str) -> str:
+    """MQTT JSON attributes topic for the given role's binary_sensor."""
+    return '/'.join((MQTT_TOPIC_BASE, f"pipewire_{role}", "attributes"))
+
+
+class StreamRecord:
+    """What we know about a single PipeWire stream node, worked out once rather than digging through props every event."""
+
+    __slots__ = ('node_id', 'media_class', 'role', 'app_id', 'pid', 'passive', 'ignored', 'state', 'counted')
+
+    def __init__(self, node_id: int, props: dict):
+        self.node_id: int = node_id
+        self.media_class: str = props.get('media.class')
+        self.pid: int | None = props.get('application.process.id')
+        self.app_id: str = "{}[{}]".format(
+            props.get('node.name', props.get('application.name', props.get('application.process.binary', ''))),
+            self.pid)
+        self.passive: bool = props.get('node.passive', False) is True
+        # FIXME: WTF is this titlecased?
+        role = props.get('media.role', 'other').lower()
+        self.role: str = role if role in PW_ROLE_NUM_STREAMS else 'other'
+        # Last known node state, such as 'running' or 'idle'
+        self.state: str | None = None
+        # Whether this is currently included in PW_ROLE_NUM_STREAMS
+        self.counted: bool = False
+
+        if self.media_class == 'Stream/Output/Audio':
+            # Pretty sure this is a playback stream.
+            # Passive streams I've seen with internal loopback & echo canceling modules.
+            # 'communication' is the hack for dealing with Discord being annoying, see below.
+            self.ignored: bool = self.passive or self.role == 'communication' or self._is_cloudflare(props)
+        else:
+            # This is a hack for dealing with Discord.
+            # I don't care if Discord is playing sound, but I do care when I'm talking to Discord.
+            # So I treat the 'communication' role special by only inhibiting it when an app is listening for Mic input
+            self.ignored: bool = self.passive or self.role != 'communication'
+
+    @staticmethod
+    def _is_cloudflare(props: dict) -> bool:
+        # Fuck off Cloudflare!!
+        # If I leave a cloudflare tab open, it just keeps spamming new "Checking your Browser…" players constantly.
+        # It doesn't actually make any sound, and it's annoying as hell.
+        proc_bin_name = props.get('application.process.binary', '')
+        return (props.get('media.name', False) in ("Checking your Browser…", "Just a moment...") and
+                ('firefox' in proc_bin_name or 'chrome' in proc_bin_name or 'chromium' in proc_bin_name))
+
+    def attributes(self) -> dict:
+        """Summary of what's playing and who owns it, for the role's JSON attributes."""
+        return {'node_id': self.node_id, 'app_id': self.app_id, 'pid': self.pid, 'state': self.state}
+
+
+def mqtt_discovery(bridge: hass_mqtt.MQTTBridge):
     """Send MQTT discovery info for Home Assistant."""
     # FIXME: Why do the DLNA & Nmap devices combine into one, but I can't make this combine with them?
-    mac_address: str = f'{uuid.getnode():02x}'
-    hex_mac: str = ':'.join(mac_address[i:i + 2] for i in range(0, len(mac_address), 2))
+    hex_mac: str = hass_mqtt.mac_address()
 
     for role in PW_ROLE_NUM_STREAMS:
-        client.publish(topic='/'.join((MQTT_TOPIC_BASE, f"pipewire_{role}", "config")),
-                       payload=json.dumps({
-                           "availability_topic": AVAILABILITY_TOPIC,
-                           "device": {
-                               "connections": [("mac", hex_mac)],
-                               "name": hostname},
-                           "device_class": "sound",
-                           # "category": "config/diagnostic",  # FIXME: wtf is this?
-                           # "icon": "mdi:monitor-speaker",
-                           # # FIXME: Not currently sending attributes anywhere
-                           # "json_attributes_topic": '/'.join((MQTT_TOPIC_BASE, "music_inhibitor", "attributes")),
-                           "name": f"Audio playback - {role}",
-                           "state_topic": '/'.join((MQTT_TOPIC_BASE, f"pipewire_{role}", "state")),
-                           "unique_id": 'pipewire'+hex_mac+role,
-                       }),
-                       retain=True)
-
-
-def read_pretty_json_list(fp: typing.TextIO):
-    """Read & decode the next pretty-printed JSON list from file object."""
-    line: str = fp.readline()
-    if line != "[\n":
-        raise NotImplementedError("Must start with a '['")
-
-    json_string = line
-    while line != "]\n":
-        line: str = fp.readline()
-        json_string += line
-
-    try:
-        return json.loads(json_string)
-    except json.decoder.JSONDecodeError:
-        print("Failed to decode event", line, file=sys.stderr)
-        raise
+        bridge.publish_discovery(topic='/'.join((MQTT_TOPIC_BASE, f"pipewire_{role}", "config")),
+                                 config={
+                                     "availability_topic": AVAILABILITY_TOPIC,
+                                     "device": {
+                                         "connections": [("mac", hex_mac)],
+                                         "name": hostname},
+                                     "device_class": "sound",
+                                     # "category": "config/diagnostic",  # FIXME: wtf is this?
+                                     # "icon": "mdi:monitor-speaker",
+                                     "json_attributes_topic": attributes_topic(role),
+                                     "name": f"Audio playback - {role}",
+                                     "state_topic": state_topic(role),
+                                     "unique_id": 'pipewire'+hex_mac+role,
+                                 })
+
+
+class JSONListStreamDecoder:
+    """Incrementally decode a byte stream of concatenated JSON lists, such as the output of `pw-dump --monitor`.
+
+    Each element of the lists is decoded & returned as soon as its closing byte has been fed in,
+    without caring about whitespace or line breaks between (or within) them.
+    Only the bytes of the current incomplete element are kept around.
+
+    The end of each list is marked with a None, since pw-dump's lists are never expected to contain nulls.
+    """
 
+    # Anything that might change the nesting depth, or end a scalar element
+    _STRUCTURAL = re.compile(rb'[][{}",]')
+    # Anything that might end a string
+    _STRING_SPECIAL = re.compile(rb'["\\\\]')
+    # Start of the next list or list element
+    _TOKEN = re.compile(rb'[^\s,]')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos: int = 0
+        self._depth: int = 0
+        self._in_string: bool = False
+        # Start offset of the list element currently being read, if any
+        self._start: int | None = None
+
+    def _decode(self, end: int):
+        element = bytes(self._buffer[self._start:end])
+        self._start = None
+        try:
+            return json.loads(element)
+        except json.decoder.JSONDecodeError:
+            print("Failed to decode event", element, file=sys.stderr)
+            raise
 
-def pipewire_events():
-    """."""
+    def feed(self, data: bytes) -> list:
+        """Feed in the next chunk of bytes, returning any list elements it completed."""
+        buf = self._buffer
+        buf += data
+        pos = self._pos
+        items = []
+        while pos < len(buf):
+            if self._in_string:
+                match = self._STRING_SPECIAL.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                elif buf[match.start()] == ord('\\'):
+                    if match.end() == len(buf):
+                        # Need the next chunk before we know what's being escaped
+                        break
+                    pos = match.end() + 1
+                else:
+                    self._in_string = False
+                    pos = match.end()
+                    if self._depth == 1:
+                        items.append(self._decode(pos))
+            elif self._start is None:
+                # Between list elements, or between lists
+                match = self._TOKEN.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    continue
+                pos = match.start()
+                if self._depth == 0:
+                    if buf[pos] != ord('['):
+                        raise NotImplementedError(f"Must start with a '[', got {bytes(buf[pos:pos + 1])}")
+                    self._depth = 1
+                    pos += 1
+                elif buf[pos] == ord(']'):
+                    self._depth = 0
+                    pos += 1
+                    items.append(None)
+                else:
+                    self._start = pos
+            else:
+                match = self._STRUCTURAL.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    continue
+                char = buf[match.start()]
+                pos = match.end()
+                if char == ord('"'):
+                    self._in_string = True
+                elif char in b'[{':
+                    self._depth += 1
+                elif char in b']}' and self._depth == 1:
+                    # Scalar element ended by the end of the list
+                    items.append(self._decode(match.start()))
+                    self._depth = 0
+                    items.append(None)
+                elif char in b']}':
+                    self._depth -= 1
+                    if self._depth == 1:
+                        items.append(self._decode(pos))
+                elif self._depth == 1:
+                    # Scalar element ended by a comma
+                    items.append(self._decode(match.start()))
+
+        # Throw away everything we've finished with
+        consumed = pos if self._start is None else self._start
+        del buf[:consumed]
+        self._pos = pos - consumed
+        if self._start is not None:
+            self._start = 0
+
+        return items
+
+
+def pw_dump_events():
+    """Yield each event object from `pw-dump --monitor` as soon as it's complete."""
     pw_dump = subprocess.Popen(['pw-dump', '--monitor', '--no-colors'],
-                               text=True, stdout=subprocess.PIPE)
-    while pw_dump.poll() is None:
-        for event in read_pretty_json_list(pw_dump.stdout):
-            yield event
+                               stdout=subprocess.PIPE)
+    decoder = JSONListStreamDecoder()
+    # read1() returns whatever is available (up to the limit) rather than waiting to fill the whole buffer
+    while (chunk := pw_dump.stdout.read1(64 * 1024)):
+        yield from decoder.feed(chunk)
+
+
+async def pw_dump_events_async():
+    """Same as pw_dump_events, but for use with asyncio."""
+    pw_dump = await asyncio.create_subprocess_exec('pw-dump', '--monitor', '--no-colors',
+                                                   stdout=asyncio.subprocess.PIPE)
+    decoder = JSONListStreamDecoder()
+    try:
+        while (chunk := await pw_dump.stdout.read(64 * 1024)):
+            for event in decoder.feed(chunk):
+                yield event
+    finally:
+        if pw_dump.returncode is None:
+            pw_dump.terminate()
+            await pw_dump.wait()
+
+
+def native_listener(backend: str):
+    """Connect to PipeWire's registry if the chosen backend allows it, otherwise return None."""
+    if backend not in ('native', 'auto'):
+        return None
+    try:
+        import pipewire_native
+        listener = pipewire_native.RegistryListener(media_classes=('Stream/Output/Audio', 'Stream/Input/Audio'))
+        listener.connect()
+    except (ImportError, OSError) as e:
+        if backend == 'native':
+            raise
+        print("Native PipeWire backend unavailable, falling back on pw-dump:", e, file=sys.stderr)
+        return None
+    return listener
 
 
-# Since upstream **still** hasn't fixed this 3yr old bug
-# https://github.com/eclipse/paho.mqtt.python/issues/493
-# I've copy/pasted upstream's connect_srv function to fix it internally.
-# I've also pushed my own pull request for them
-# https://github.com/eclipse/paho.mqtt.python/pull/759
-# but I get the feeling it's going to be ignored
-# -- mijofa, 2023-10-23
-def connect_srv(mqtt_client, domain=None, *args, **kwargs):
-    """Connect to a remote broker.
+def pipewire_events(backend: str):
+    """Yield pw-dump style events from the chosen backend, with a None after each batch of events."""
+    if (listener := native_listener(backend)) is not None:
+        return listener.events()
+    return pw_dump_events()
 
-    domain is the DNS domain to search for SRV records; if None,
-    try to determine local domain name.
-    All other args are used as is for connect()
-    """
-    if domain is None:
-        domain = socket.getfqdn()
-        domain = domain[domain.find('.') + 1:]
 
-    try:
-        rr = '_mqtt._tcp.%s' % domain
-        if mqtt_client._ssl:
-            # IANA specifies secure-mqtt (not mqtts) for port 8883
-            rr = '_secure-mqtt._tcp.%s' % domain
-        answers = []
-        for answer in dns.resolver.resolve(rr, dns.rdatatype.SRV):
-            addr = answer.target.to_text()[:-1]
-            answers.append(
-                (addr, answer.port, answer.priority, answer.weight))
-    except (dns.resolver.NXDOMAIN,
-            dns.resolver.NoAnswer,
-            dns.resolver.NoNameservers):
-        raise ValueError("No answer/NXDOMAIN for SRV in %s" % (domain))
-
-    # FIXME: doesn't account for weight
-    for answer in answers:
-        host, port, prio, weight = answer
+async def pipewire_events_async(backend: str):
+    """Same as pipewire_events, but for use with asyncio."""
+    if (listener := native_listener(backend)) is None:
+        async for event in pw_dump_events_async():
+            yield event
+        return
 
+    loop = asyncio.get_running_loop()
+    while True:
+        readable = loop.create_future()
+        loop.add_reader(listener.fileno(), readable.set_result, None)
         try:
-            return mqtt_client.connect(host, port, *args, **kwargs)
-        except Exception:
-            raise
-
-    raise ValueError("No SRV hosts responded")
-
-
-mqtt_client = paho.mqtt.client.Client()
-# NOTE: The will must be set before connecting.
-mqtt_client.will_set(topic=AVAILABILITY_TOPIC, payload='offline')
+            await readable
+        finally:
+            loop.remove_reader(listener.fileno())
+        if not (data := listener.recv()):
+            break
+        for event in listener.feed(data):
+            yield event
 
-# FIXME: Try anonymous, and fallback on guest:guest when that fails
-mqtt_client.username_pw_set(username='guest', password='guest')
-connect_srv(mqtt_client)
-mqtt_client.loop_start()
 
-# FIXME: Can I make this wait until after the first load of events is handled before first updating the payload?
-#        Because that first set of dumped events tends to bounce the inhibitor on/off annoyingly.
-# FIXME: Notify Systemd that we're ready, perhaps at the same time as ^ FIXME?
-mqtt_discovery(mqtt_client)
-mqtt_client.publish(topic=AVAILABILITY_TOPIC, payload='online', retain=False)
+class StatePublisher:
+    """Coalesce the role states over a short window and only publish the ones that actually changed.
 
-# Set everything to off before we get started
-for mqtt_topic in ('/'.join((MQTT_TOPIC_BASE, f"pipewire_{role}", "state")) for role in PW_ROLE_NUM_STREAMS):
-    mqtt_client.publish(topic=mqtt_topic,
-                        payload='OFF',
-                        retain=True)
+    Nothing is published until sync() is first called, so the initial dump of already existing streams
+    doesn't bounce the sensors on & off while it's being processed.
+    """
 
-def add_stream(stream_id: int, stream_role: typing.Literal[*PW_ROLE_NUM_STREAMS.keys()], app_id: str = ''):
+    def __init__(self, bridge: hass_mqtt.MQTTBridge, window: float,
+                 call_later: typing.Callable[[float, typing.Callable], typing.Any] | None = None):
+        self.bridge = bridge
+        self.window = window
+        self._call_later = call_later or self._timer_call_later
+        self._lock = threading.Lock()
+        # {topic: payload} not yet published, and last published
+        self._pending: dict[str, str] = {}
+        self._published: dict[str, str] = {}
+        self._flush_scheduled = False
+        self.ready = False
+        # Number of publishes that were skipped because they were redundant or superseded
+        self.suppressed = 0
+
+    @staticmethod
+    def _timer_call_later(delay: float, callback: typing.Callable):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def set_state(self, role: str, payload: str):
+        """Queue the role's state to be published at the end of the current window."""
+        self._queue(state_topic(role), payload)
+
+    def set_attributes(self, role: str, payload: str):
+        """Queue the role's JSON attributes to be published at the end of the current window."""
+        self._queue(attributes_topic(role), payload)
+
+    def _queue(self, topic: str, payload: str):
+        with self._lock:
+            if topic in self._pending:
+                self.suppressed += 1
+            self._pending[topic] = payload
+            if self.ready and not self._flush_scheduled:
+                self._flush_scheduled = True
+                self._call_later(self.window, self.flush)
+
+    def sync(self):
+        """Mark the end of a batch of events, the first of which is the initial dump."""
+        if not self.ready:
+            self.ready = True
+            self.flush()
+            self.bridge.set_available(True)
+
+    def flush(self):
+        """Publish any queued states that differ from what was last published."""
+        with self._lock:
+            self._flush_scheduled = False
+            pending, self._pending = self._pending, {}
+            published = 0
+            for topic, payload in pending.items():
+                if self._published.get(topic) == payload:
+                    self.suppressed += 1
+                    continue
+                self.bridge.publish(topic=topic, payload=payload, retain=True)
+                self._published[topic] = payload
+                published += 1
+            if published:
+                print(f"Published {published} updates, suppressed {self.suppressed} so far", flush=True)
+
+
+argparser = argparse.ArgumentParser(description=__doc__)
+argparser.add_argument('--backend', choices=('pw-dump', 'native', 'auto'), default='pw-dump',
+                       help=("Where to get PipeWire events from. "
+                             "'native' talks to PipeWire's registry directly rather than parsing pw-dump's full output, "
+                             "'auto' tries that and falls back on pw-dump"))
+argparser.add_argument('--debounce', type=float, default=1.0,
+                       help="Seconds to wait for a role's state to settle before publishing it")
+argparser.add_argument('--heartbeat-interval', type=float, default=60,
+                       help="Seconds between pings of the availability topic")
+argparser.add_argument('--asyncio', action='store_true',
+                       help="Run PipeWire & MQTT on a single asyncio event loop rather than separate threads")
+args = argparser.parse_args()
+
+bridge = hass_mqtt.MQTTBridge(AVAILABILITY_TOPIC, heartbeat_interval=args.heartbeat_interval)
+if args.asyncio:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    mqtt_driver = hass_mqtt.AsyncioDriver(bridge, loop)
+    mqtt_driver.start()
+else:
+    bridge.connect()
+    bridge.loop_start()
+
+# FIXME: Notify Systemd that we're ready, perhaps when the publisher first syncs?
+mqtt_discovery(bridge)
+publisher = StatePublisher(bridge, window=args.debounce,
+                           call_later=loop.call_later if args.asyncio else None)
+
+# {node id: record} for every stream node we've seen
+streams: dict[int, StreamRecord] = {}
+
+
+def role_attributes(role: str) -> str:
+    """JSON attributes listing the streams currently counted for the role."""
+    # Only ever called from the thread handling the events,
+    # the publisher's flush might be on another thread and mustn't go near 'streams' itself.
+    return json.dumps({'streams': [record.attributes() for record in streams.values()
+                                   if record.counted and record.role == role]})
+
+
+# Set everything to off before we get started,
+# the publisher will hold onto this until the initial dump is processed and only send the final state.
+for role in PW_ROLE_NUM_STREAMS:
+    publisher.set_state(role, 'OFF')
+    publisher.set_attributes(role, role_attributes(role))
+
+
+def add_stream(record: StreamRecord):
     # Don't bother logging & publishing an update if we've already handled this one
     # Just reduces log spam
-    if stream_id in PW_ROLE_NUM_STREAMS[stream_role]:
+    if record.counted:
         return
 
-    PW_ROLE_NUM_STREAMS[stream_role].add(stream_id)
-    print(f"{stream_id} - new {stream_role} stream",
-            app_id,
-            f"total = {len(PW_ROLE_NUM_STREAMS[stream_role])}",
-            sep=', ')
-    mqtt_client.publish(topic='/'.join((MQTT_TOPIC_BASE,
-                                        f"pipewire_{stream_role}",
-                                        "state")),
-                        payload='ON',
-                        retain=True)
+    record.counted = True
+    PW_ROLE_NUM_STREAMS[record.role] += 1
+    print(f"{record.node_id} - new {record.role} stream",
+          record.app_id,
+          f"total = {PW_ROLE_NUM_STREAMS[record.role]}",
+          sep=', ')
+    publisher.set_state(record.role, 'ON')
+    publisher.set_attributes(record.role, role_attributes(record.role))
 
-    # Keep record of what role this was so that we can track it on deletion
-    playback_streams[stream_id] = stream_role
 
+def subtract_stream(record: StreamRecord):
+    if not record.counted:
+        return
 
-def subtract_stream(stream_id: int):
-    if stream_id not in playback_streams:
+    record.counted = False
+    PW_ROLE_NUM_STREAMS[record.role] -= 1
+    print(f"{record.node_id} - del {record.role} stream",
+          record.app_id,
+          f"total = {PW_ROLE_NUM_STREAMS[record.role]}",
+          sep=', ')
+    if PW_ROLE_NUM_STREAMS[record.role] == 0:
+        publisher.set_state(record.role, 'OFF')
+    publisher.set_attributes(record.role, role_attributes(record.role))
+
+
+def handle_event(ev: dict | None):
+    """Update the role states from a single PipeWire event."""
+    if ev is None:
+        # End of a batch of events, the first time this happens the initial dump is done.
+        publisher.sync()
         return
-    if (stream_role := playback_streams.pop(stream_id)) in PW_ROLE_NUM_STREAMS:
-        PW_ROLE_NUM_STREAMS[stream_role].remove(stream_id)
-        print(f"{stream_id} - del {stream_role} stream,",
-            f"total = {len(PW_ROLE_NUM_STREAMS[stream_role])}",
-            PW_ROLE_NUM_STREAMS[stream_role])
-        if len(PW_ROLE_NUM_STREAMS[stream_role]) == 0:
-            mqtt_client.publish(topic='/'.join((MQTT_TOPIC_BASE, f"pipewire_{stream_role}", "state")),
-                                payload='OFF',
-                                retain=True)
-
-
-# This is a mapping of {stream_id: stream_role} so that we don't have to iterate all of 'PW_ROLE_NUM_STREAMS' to find a stream.
-playback_streams: dict[int, str] = {}
-for ev in pipewire_events():
-    if 'type' not in ev and ev.get('info') is None:
+    elif 'type' not in ev and ev.get('info') is None:
         # This is a node being removed, but we don't know what type of node
-        subtract_stream(ev['id'])
+        if (record := streams.pop(ev['id'], None)) is not None:
+            subtract_stream(record)
 
     elif ev.get('type') == 'PipeWire:Interface:Node':
-        match ev['info']['props'].get('media.class'):
-            case 'Stream/Output/Audio':
-                # Pretty sure this is a playback stream.
-                if ev['info']['props'].get('node.passive', False) is True:
-                    # I've seen this with internal loopback & echo canceling modules.
-                    continue
-                elif 'state' not in ev['info']['change-mask'] and 'params' not in ev['info']['change-mask']:
-                    # Don't care about anything other than state changes
-                    continue
-                if ev['info']['state'] == 'idle':
-                    # Media paused? Firefox sets this when a video is paused
-                    subtract_stream(ev['id'])
-                    continue
-
-                # Fuck off Cloudflare!!
-                proc_bin_name = ev['info']['props'].get('application.process.binary', '')
-                if (ev['info']['props'].get('media.name', False) in ("Checking your Browser…", "Just a moment...") and
-                        ('firefox' in proc_bin_name or 'chrome' in proc_bin_name or 'chromium' in proc_bin_name)):
-                    # If I leave a cloudflare tab open, it just keeps spamming new "Checking your Browser…" players constantly.
-                    # It doesn't actually make any sound, and it's annoying as hell.
-                    continue
-
-                # FIXME: WTF is this titlecased?
-                stream_role: str = ev['info']['props'].get('media.role', 'other').lower()
-                if stream_role == 'communication':
-                    # Hack for dealing with Discord being annoying
-                    continue
-                if stream_role not in PW_ROLE_NUM_STREAMS:
-                    stream_role = 'other'
-
-                add_stream(stream_id=ev['id'],
-                           stream_role=stream_role,
-                           app_id=f"""{ev['info']['props'].get('node.name',
-                                        ev['info']['props'].get('application.name',
-                                            ev['info']['props'].get('application.process.binary', '')))}[{ev['info']['props'].get('application.process.id')}]""")
-
-            case 'Stream/Input/Audio':
-                # This is a hack for dealing with Discord.
-                # I don't care if Discord is playing sound, but I do care when I'm talking to Discord.
-                # So I treat the 'communication' role special by only inhibiting it when an app is listening for Mic input
-                if ev['info']['props'].get('node.passive', False) is True:
-                    continue
-                elif 'state' not in ev['info']['change-mask'] and 'params' not in ev['info']['change-mask']:
-                    continue
-                stream_role: str = ev['info']['props'].get('media.role', 'other').lower()
-                if stream_role != 'communication':
-                    continue
-                add_stream(stream_id=ev['id'],
-                           stream_role=stream_role,
-                           app_id=f"""{ev['info']['props'].get('node.name',
-                                        ev['info']['props'].get('application.name',
-                                            ev['info']['props'].get('application.process.binary', '')))}[{ev['info']['props'].get('application.process.id')}]""")
-
-            case 'Audio/Sink':
-                # Pretty sure this is output sinks
-                if 'params' not in ev['info']['change-mask']:
-                    # Don't care about changes outside of 'params'
-                    continue
-
-    # Ping the availability topic in case HA has restarted and forgotten latest state
-    mqtt_client.publish(topic=AVAILABILITY_TOPIC, payload='online', retain=False)
+        info = ev['info']
+        record = streams.get(ev['id'])
+        if record is None or 'props' in info['change-mask']:
+            if info['props'].get('media.class') not in ('Stream/Output/Audio', 'Stream/Input/Audio'):
+                # Output sinks & such, don't care
+                return
+            new_record = StreamRecord(ev['id'], info['props'])
+            if record is not None and record.counted:
+                if new_record.ignored or new_record.role != record.role:
+                    subtract_stream(record)
+                else:
+                    new_record.counted = True
+            streams[ev['id']] = record = new_record
+
+        if record.ignored:
+            return
+        elif 'state' not in info['change-mask'] and 'params' not in info['change-mask']:
+            # Don't care about anything other than state changes
+            return
+
+        record.state = info['state']
+        if record.state == 'idle' and record.media_class == 'Stream/Output/Audio':
+            # Media paused? Firefox sets this when a video is paused
+            subtract_stream(record)
+            return
+
+        add_stream(record)
+
+
+async def async_main(backend: str):
+    """Feed the PipeWire events through the state machine until cancelled or PipeWire goes away."""
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, main_task.cancel)
+    try:
+        async for ev in pipewire_events_async(backend):
+            handle_event(ev)
+    except asyncio.CancelledError:
+        print("Shutting down", file=sys.stderr, flush=True)
+    finally:
+        # The will only covers unclean disconnects
+        bridge.set_available(False)
+        await mqtt_driver.disconnect()
+
+
+if args.asyncio:
+    loop.run_until_complete(async_main(args.backend))
+else:
+    for ev in pipewire_events(args.backend):
+        handle_event(ev)
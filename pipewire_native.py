@@ -0,0 +1,449 @@
+#!/usr/bin/python3
+"""Minimal PipeWire native protocol client that only follows the registry's nodes.
+
+This speaks just enough of the protocol to list nodes, bind the interesting ones,
+and hear about their state changes, without dumping every prop/param/format like pw-dump does.
+Events are yielded in the same shape as `pw-dump --monitor` objects so they can be handled the same way,
+with a None once the initial set of nodes has been dumped, like the end of pw-dump's first list.
+
+Running this directly will print the events, or with --fake-server will pretend to be a PipeWire daemon,
+so the client can be tested without a real one:
+
+    ./pipewire_native.py --fake-server /tmp/pw-fake &
+    PIPEWIRE_REMOTE=/tmp/pw-fake ./pipewire-mqtt.py --backend native
+"""
+import argparse
+import json
+import os
+import pathlib
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import typing
+
+# Message header is: object id, opcode << 24 | body size, sequence number, number of fds
+HEADER = struct.Struct('=IIII')
+
+# SPA POD types, ref: spa/utils/type.h
+POD_NONE = 1
+POD_BOOL = 2
+POD_ID = 3
+POD_INT = 4
+POD_LONG = 5
+POD_FLOAT = 6
+POD_DOUBLE = 7
+POD_STRING = 8
+POD_BYTES = 9
+POD_STRUCT = 14
+
+# Well known object ids, everything after these is allocated by the client as it binds things
+CORE_ID = 0
+CLIENT_ID = 1
+REGISTRY_ID = 2
+
+# ref: pipewire/core.h
+CORE_METHOD_HELLO = 1
+CORE_METHOD_SYNC = 2
+CORE_METHOD_PONG = 3
+CORE_METHOD_GET_REGISTRY = 5
+CORE_METHOD_DESTROY = 7
+CORE_EVENT_DONE = 1
+CORE_EVENT_PING = 2
+CORE_EVENT_ERROR = 3
+CORE_EVENT_REMOVE_ID = 4
+# ref: pipewire/client.h
+CLIENT_METHOD_UPDATE_PROPERTIES = 2
+# ref: pipewire/registry.h
+REGISTRY_METHOD_BIND = 1
+REGISTRY_EVENT_GLOBAL = 0
+REGISTRY_EVENT_GLOBAL_REMOVE = 1
+# ref: pipewire/node.h
+NODE_EVENT_INFO = 0
+
+VERSION_CORE = 3
+VERSION_REGISTRY = 3
+VERSION_NODE = 3
+
+NODE_TYPE = 'PipeWire:Interface:Node'
+# Same names pw-dump uses for the change-mask bits & node states
+NODE_CHANGE_MASK = ('input-ports', 'output-ports', 'state', 'props', 'params')
+NODE_CHANGE_MASK_STATE = 1 << NODE_CHANGE_MASK.index('state')
+NODE_CHANGE_MASK_PROPS = 1 << NODE_CHANGE_MASK.index('props')
+NODE_STATES = {-1: 'error', 0: 'creating', 1: 'suspended', 2: 'idle', 3: 'running'}
+
+# Property values that pw-dump would output as JSON literals rather than strings
+_JSON_LITERAL = re.compile(r'true|false|null|-?\d+(\.\d+)?([eE][-+]?\d+)?')
+
+
+def _pod(pod_type: int, body: bytes) -> bytes:
+    return struct.pack('=II', len(body), pod_type) + body + b'\0' * (-len(body) % 8)
+
+
+def pod_int(value: int) -> bytes:
+    """Encode an Int POD."""
+    return _pod(POD_INT, struct.pack('=i', value))
+
+
+def pod_long(value: int) -> bytes:
+    """Encode a Long POD."""
+    return _pod(POD_LONG, struct.pack('=q', value))
+
+
+def pod_id(value: int) -> bytes:
+    """Encode an Id POD."""
+    return _pod(POD_ID, struct.pack('=I', value & 0xffffffff))
+
+
+def pod_string(value: str | None) -> bytes:
+    """Encode a String POD, or a None POD for NULL strings."""
+    if value is None:
+        return _pod(POD_NONE, b'')
+    return _pod(POD_STRING, value.encode() + b'\0')
+
+
+def pod_struct(*children: bytes) -> bytes:
+    """Encode a Struct POD of already encoded children."""
+    return _pod(POD_STRUCT, b''.join(children))
+
+
+def pod_dict(items: dict[str, str]) -> bytes:
+    """Encode a dict the way PipeWire's protocol marshals spa_dicts."""
+    return pod_struct(pod_int(len(items)),
+                      *(pod_string(k) + pod_string(v) for k, v in items.items()))
+
+
+def parse_pod(data: bytes, offset: int = 0) -> tuple[typing.Any, int]:
+    """Decode the POD at offset, returning its value and the offset of whatever follows it."""
+    size, pod_type = struct.unpack_from('=II', data, offset)
+    body = data[offset + 8:offset + 8 + size]
+    next_offset = offset + 8 + size + (-size % 8)
+    match pod_type:
+        case 1:  # POD_NONE
+            value = None
+        case 2:  # POD_BOOL
+            value = bool(struct.unpack('=i', body)[0])
+        case 3:  # POD_ID
+            value = struct.unpack('=I', body)[0]
+        case 4:  # POD_INT
+            value = struct.unpack('=i', body)[0]
+        case 5:  # POD_LONG
+            value = struct.unpack('=q', body)[0]
+        case 6:  # POD_FLOAT
+            value = struct.unpack('=f', body)[0]
+        case 7:  # POD_DOUBLE
+            value = struct.unpack('=d', body)[0]
+        case 8:  # POD_STRING
+            value = body.rstrip(b'\0').decode(errors='replace')
+        case 14:  # POD_STRUCT
+            value = []
+            child_offset = 0
+            while child_offset < size:
+                child, child_offset = parse_pod(body, child_offset)
+                value.append(child)
+        case _:
+            # Nothing we care about (objects, arrays, choices, etc), just leave it raw
+            value = body
+    return value, next_offset
+
+
+def parse_dict(fields: list) -> dict[str, str]:
+    """Turn a decoded spa_dict struct back into a dict."""
+    return dict(zip(fields[1::2], fields[2::2]))
+
+
+def _props_value(value: str | None):
+    if value is not None and _JSON_LITERAL.fullmatch(value):
+        return json.loads(value)
+    return value
+
+
+def default_socket_path() -> pathlib.Path:
+    """Find the PipeWire socket the same way libpipewire does."""
+    remote = os.environ.get('PIPEWIRE_REMOTE', 'pipewire-0')
+    if remote.startswith('/'):
+        return pathlib.Path(remote)
+    runtime_dir = (os.environ.get('PIPEWIRE_RUNTIME_DIR') or os.environ.get('XDG_RUNTIME_DIR') or
+                   os.environ.get('USERPROFILE') or f'/run/user/{os.getuid()}')
+    return pathlib.Path(runtime_dir, remote)
+
+
+class Connection:
+    """Message framing shared by the client & the fake server."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._buffer = bytearray()
+        self._seq = 0
+        self._send_lock = threading.Lock()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, obj_id: int, opcode: int, body: bytes):
+        """Send a single message."""
+        with self._send_lock:
+            self.sock.sendall(HEADER.pack(obj_id, opcode << 24 | len(body), self._seq, 0) + body)
+            self._seq += 1
+
+    def recv(self) -> bytes:
+        """Receive whatever is available, closing any fds that came along with it."""
+        data, fds, _flags, _addr = socket.recv_fds(self.sock, 64 * 1024, 16)
+        for fd in fds:
+            os.close(fd)
+        return data
+
+    def messages(self, data: bytes) -> typing.Iterator[tuple[int, int, list]]:
+        """Frame the received bytes into (object id, opcode, args) messages."""
+        buf = self._buffer
+        buf += data
+        while len(buf) >= HEADER.size:
+            obj_id, opcode_size, _seq, _n_fds = HEADER.unpack_from(buf)
+            size = opcode_size & 0xffffff
+            if len(buf) < HEADER.size + size:
+                break
+            body = bytes(buf[HEADER.size:HEADER.size + size])
+            del buf[:HEADER.size + size]
+            # Newer servers may add a footer after the args, which we don't care about.
+            yield obj_id, opcode_size >> 24, parse_pod(body)[0] if body else []
+
+
+class RegistryListener(Connection):
+    """Follow the nodes in PipeWire's registry, yielding pw-dump style events for their state changes."""
+
+    def __init__(self, media_classes: typing.Container[str]):
+        self.media_classes = media_classes
+        self._next_id = REGISTRY_ID + 1
+        # {proxy id: global id} for each node we've bound
+        self._proxies: dict[int, int] = {}
+        # {global id: props} for each node we've bound
+        self._nodes: dict[int, dict] = {}
+        # Sequence number of the last Core.Sync we sent
+        self._sync_seq = 0
+
+    def connect(self, path: pathlib.Path | None = None):
+        """Connect to the PipeWire daemon and start listening to the registry."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(path or default_socket_path()))
+        except OSError:
+            sock.close()
+            raise
+        super().__init__(sock)
+
+        self.send(CORE_ID, CORE_METHOD_HELLO, pod_struct(pod_int(VERSION_CORE)))
+        self.send(CLIENT_ID, CLIENT_METHOD_UPDATE_PROPERTIES, pod_struct(pod_dict({
+            'application.name': pathlib.Path(sys.argv[0]).name,
+            'application.process.id': str(os.getpid()),
+        })))
+        self.send(CORE_ID, CORE_METHOD_GET_REGISTRY, pod_struct(pod_int(VERSION_REGISTRY), pod_int(REGISTRY_ID)))
+        # The first Sync is done once all the existing globals have been announced,
+        # the second once all the nodes we've bound from that have sent their info.
+        self._sync()
+
+    def _sync(self):
+        self._sync_seq += 1
+        self.send(CORE_ID, CORE_METHOD_SYNC, pod_struct(pod_int(CORE_ID), pod_int(self._sync_seq)))
+
+    def feed(self, data: bytes) -> list[dict | None]:
+        """Handle the received bytes, returning any node events."""
+        events = []
+        for obj_id, opcode, args in self.messages(data):
+            if obj_id == CORE_ID:
+                events.extend(self._handle_core(opcode, args))
+            elif obj_id == REGISTRY_ID:
+                events.extend(self._handle_registry(opcode, args))
+            elif obj_id in self._proxies and opcode == NODE_EVENT_INFO:
+                events.extend(self._handle_node_info(self._proxies[obj_id], args))
+        return events
+
+    def events(self) -> typing.Iterator[dict | None]:
+        """Yield node events until the daemon hangs up."""
+        while (data := self.recv()):
+            yield from self.feed(data)
+
+    def _handle_core(self, opcode: int, args: list) -> list[None]:
+        if opcode == CORE_EVENT_DONE and args[0] == CORE_ID and args[1] == self._sync_seq:
+            if self._sync_seq == 1:
+                self._sync()
+            elif self._sync_seq == 2:
+                return [None]
+        elif opcode == CORE_EVENT_PING:
+            self.send(CORE_ID, CORE_METHOD_PONG, pod_struct(pod_int(args[0]), pod_int(args[1])))
+        elif opcode == CORE_EVENT_REMOVE_ID:
+            # The daemon has destroyed the node we bound, before telling the registry the global is gone
+            self._proxies.pop(args[0], None)
+        elif opcode == CORE_EVENT_ERROR:
+            obj_id, _seq, res, message = args[:4]
+            if obj_id in (CORE_ID, CLIENT_ID, REGISTRY_ID):
+                raise ConnectionError(f"PipeWire error {res} on object {obj_id}: {message}")
+            # Most likely the node went away before we could bind it, we'll get a global_remove for it soon enough.
+            print(f"PipeWire error {res} on proxy {obj_id}: {message}", file=sys.stderr)
+        return []
+
+    def _handle_registry(self, opcode: int, args: list) -> list[dict]:
+        if opcode == REGISTRY_EVENT_GLOBAL:
+            global_id, _permissions, obj_type, _version, props = args[:5]
+            props = parse_dict(props)
+            if obj_type == NODE_TYPE and props.get('media.class') in self.media_classes:
+                proxy_id = self._next_id
+                self._next_id += 1
+                self._proxies[proxy_id] = global_id
+                self._nodes[global_id] = {key: _props_value(value) for key, value in props.items()}
+                self.send(REGISTRY_ID, REGISTRY_METHOD_BIND, pod_struct(
+                    pod_int(global_id), pod_string(NODE_TYPE), pod_int(VERSION_NODE), pod_int(proxy_id)))
+        elif opcode == REGISTRY_EVENT_GLOBAL_REMOVE:
+            global_id = args[0]
+            # The daemon already destroyed our proxy for it and sent remove_id, so there's nothing to destroy.
+            # Just make sure the mapping's gone in case that got lost along the way.
+            for proxy_id in [proxy_id for proxy_id, proxied_id in self._proxies.items() if proxied_id == global_id]:
+                del self._proxies[proxy_id]
+            if self._nodes.pop(global_id, None) is not None:
+                # Same as what pw-dump gives us for a removed object
+                return [{'id': global_id, 'info': None}]
+        return []
+
+    def _handle_node_info(self, global_id: int, args: list) -> list[dict]:
+        if global_id not in self._nodes:
+            return []
+        change_mask, state, props = args[3], args[6], args[8]
+        if change_mask & NODE_CHANGE_MASK_PROPS:
+            self._nodes[global_id].update({key: _props_value(value) for key, value in parse_dict(props).items()})
+        if not change_mask & NODE_CHANGE_MASK_STATE:
+            # We only care about state changes, not port or param updates
+            return []
+        return [{
+            'id': global_id,
+            'type': NODE_TYPE,
+            'info': {
+                'change-mask': [name for bit, name in enumerate(NODE_CHANGE_MASK) if change_mask & 1 << bit],
+                # Id PODs are unsigned, but the error state is -1
+                'state': NODE_STATES.get(state - (1 << 32) if state & 1 << 31 else state, 'error'),
+                'props': self._nodes[global_id],
+            },
+        }]
+
+
+class FakePipeWireServer:
+    """Just enough of a PipeWire daemon to test RegistryListener against."""
+
+    def __init__(self, path: pathlib.Path, nodes: dict[int, dict[str, str]]):
+        self.path = path
+        # {global id: props}
+        self.nodes = nodes
+        self.states: dict[int, int] = {global_id: 3 for global_id in nodes}
+        # {global id: proxy id} for each node the client has bound
+        self.bound: dict[int, int] = {}
+        self.conn: Connection | None = None
+        self.registry_id: int | None = None
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(str(path))
+        self._listener.listen(1)
+
+    def serve(self):
+        """Handle a single client until it disconnects."""
+        sock, _addr = self._listener.accept()
+        self.conn = Connection(sock)
+        self.conn.send(CORE_ID, CORE_EVENT_PING, pod_struct(pod_int(CORE_ID), pod_int(0)))
+        while (data := self.conn.recv()):
+            for obj_id, opcode, args in self.conn.messages(data):
+                if obj_id == CORE_ID and opcode == CORE_METHOD_GET_REGISTRY:
+                    self.registry_id = args[1]
+                    # A global the client should ignore
+                    self.conn.send(self.registry_id, REGISTRY_EVENT_GLOBAL, pod_struct(
+                        pod_int(0), pod_int(0o700), pod_string('PipeWire:Interface:Core'), pod_int(4),
+                        pod_dict({'object.serial': '0'})))
+                    for global_id, props in self.nodes.items():
+                        self.conn.send(self.registry_id, REGISTRY_EVENT_GLOBAL, pod_struct(
+                            pod_int(global_id), pod_int(0o700), pod_string(NODE_TYPE), pod_int(VERSION_NODE),
+                            pod_dict({k: v for k, v in props.items() if k in ('media.class', 'node.name')})))
+                elif obj_id == CORE_ID and opcode == CORE_METHOD_SYNC:
+                    self.conn.send(CORE_ID, CORE_EVENT_DONE, pod_struct(pod_int(args[0]), pod_int(args[1])))
+                elif obj_id == CORE_ID and opcode == CORE_METHOD_DESTROY:
+                    if args[0] in self.bound.values():
+                        self.bound = {global_id: proxy_id for global_id, proxy_id in self.bound.items()
+                                      if proxy_id != args[0]}
+                        self.conn.send(CORE_ID, CORE_EVENT_REMOVE_ID, pod_struct(pod_int(args[0])))
+                    else:
+                        # Like the real daemon, which takes it as the client being confused
+                        self.conn.send(CORE_ID, CORE_EVENT_ERROR, pod_struct(
+                            pod_int(CORE_ID), pod_int(0), pod_int(-2), pod_string(f"unknown resource {args[0]}")))
+                elif obj_id == self.registry_id and opcode == REGISTRY_METHOD_BIND:
+                    global_id, _type, _version, proxy_id = args
+                    self.bound[global_id] = proxy_id
+                    self._send_info(global_id, 0b11111)
+        sock.close()
+
+    def close(self):
+        self._listener.close()
+        self.path.unlink(missing_ok=True)
+
+    def _send_info(self, global_id: int, change_mask: int):
+        self.conn.send(self.bound[global_id], NODE_EVENT_INFO, pod_struct(
+            pod_int(global_id), pod_int(1), pod_int(1), pod_long(change_mask), pod_int(0), pod_int(1),
+            pod_id(self.states[global_id]), pod_string(None),
+            pod_dict(self.nodes[global_id] if change_mask & NODE_CHANGE_MASK_PROPS else {}),
+            pod_struct(pod_int(0))))
+
+    def set_state(self, global_id: int, state: int):
+        """Change a node's state, notifying the client if it has bound that node."""
+        self.states[global_id] = state
+        if global_id in self.bound:
+            self._send_info(global_id, NODE_CHANGE_MASK_STATE)
+
+    def remove(self, global_id: int):
+        """Remove a node from the registry, destroying the client's proxy for it first like the real daemon does."""
+        del self.nodes[global_id], self.states[global_id]
+        proxy_id = self.bound.pop(global_id, None)
+        if proxy_id is not None:
+            self.conn.send(CORE_ID, CORE_EVENT_REMOVE_ID, pod_struct(pod_int(proxy_id)))
+        self.conn.send(self.registry_id, REGISTRY_EVENT_GLOBAL_REMOVE, pod_struct(pod_int(global_id)))
+
+
+def run_fake_server(path: pathlib.Path, interval: float):
+    """Serve a canned scenario of a music stream that pauses, and a call that hangs up."""
+    server = FakePipeWireServer(path, {
+        42: {'media.class': 'Stream/Output/Audio', 'media.role': 'Music', 'node.name': 'Firefox',
+             'application.process.binary': 'firefox', 'application.process.id': '1234'},
+        43: {'media.class': 'Stream/Input/Audio', 'media.role': 'Communication', 'node.name': 'WEBRTC VoiceEngine',
+             'application.process.binary': 'Discord', 'application.process.id': '4321'},
+        44: {'media.class': 'Audio/Sink', 'node.name': 'alsa_output.pci-0000_00_1f.3.analog-stereo'},
+        45: {'media.class': 'Stream/Output/Audio', 'node.name': 'echo-cancel-playback', 'node.passive': 'true'},
+    })
+    print(f"Fake PipeWire daemon listening on {path}", file=sys.stderr)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    try:
+        while not server.bound:
+            time.sleep(0.1)
+        for action in (lambda: server.set_state(42, 2), lambda: server.remove(43),
+                       lambda: server.set_state(42, 3), lambda: server.remove(42)):
+            time.sleep(interval)
+            action()
+        # Hang up, like the daemon restarting
+        time.sleep(interval)
+        server.conn.sock.shutdown(socket.SHUT_RDWR)
+        thread.join()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('socket_path', type=pathlib.Path, nargs='?',
+                           help="PipeWire socket to connect to (default: same as libpipewire)")
+    argparser.add_argument('--fake-server', action='store_true',
+                           help="Pretend to be a PipeWire daemon on socket_path instead of connecting to one")
+    argparser.add_argument('--interval', type=float, default=2,
+                           help="Seconds between each of the fake server's events")
+    args = argparser.parse_args()
+
+    if args.fake_server:
+        run_fake_server(args.socket_path or pathlib.Path('pipewire-fake'), args.interval)
+    else:
+        listener = RegistryListener(media_classes=('Stream/Output/Audio', 'Stream/Input/Audio'))
+        listener.connect(args.socket_path)
+        for event in listener.events():
+            print(json.dumps(event), flush=True)
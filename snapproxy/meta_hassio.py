@@ -39,7 +39,15 @@ import gettext
 import time
 import json
 import musicbrainzngs
+import codecs
 import fcntl
+import functools
+import hashlib
+import http.server
+import queue
+import random
+import sqlite3
+import threading
 
 __version__ = "@version@"
 __git_version__ = "@gitversion@"
@@ -61,6 +69,7 @@ except ImportError:
 
 # _ = gettext.gettext
 
+logger = logging.getLogger('meta_mpd')
 
 params = {
     'progname': sys.argv[0],
@@ -71,6 +80,15 @@ params = {
     'snapcast-host': None,
     'snapcast-port': None,
     'stream': None,
+    'poll-interval': None,
+    'art-cache': None,
+    'art-cache-size': None,
+    'art-dir': None,
+    'art-dir-size': None,
+    'art-port': None,
+    'art-url': None,
+    'serve-art': False,
+    'serve': None,
 }
 
 defaults = {
@@ -81,6 +99,19 @@ defaults = {
     'snapcast-host': 'localhost',
     'snapcast-port': 1780,
     'stream': 'default',
+    # Only poll MPD if asked to, or it doesn't support idle
+    'poll-interval': None,
+    # /data is the add-on's persistent storage, keep the cache in memory if we're not running as an add-on
+    'art-cache': '/data/album_art.sqlite' if os.path.isdir('/data') else ':memory:',
+    'art-cache-size': 5000,
+    # Somewhere persistent to keep cover art from MPD,
+    # only used with --serve-art or --art-url, as otherwise nothing is serving it
+    'art-dir': '/data/art' if os.path.isdir('/data') else None,
+    # In MB, the least recently used images get removed past this
+    'art-dir-size': 100,
+    'art-port': 1788,
+    # Worked out from the hostname & art-port if not set
+    'art-url': None,
 }
 
 # Player.Status
@@ -176,6 +207,24 @@ tag_mapping = {
 }
 
 
+def _tag_converter(cast, is_list):
+    """
+    Build the function converting an MPD tag's value(s) to Snapcast's,
+    python-mpd2 gives a list for tags that appear more than once.
+    """
+    if is_list:
+        return lambda values: [cast(value) for value in values] if type(values) == list else [cast(values)]
+    else:
+        return lambda values: cast(values[0]) if type(values) == list else cast(values)
+
+
+# Compiled once here rather than digging through the mappings for every key of every update
+# {<mpd key>: (<snapcast key>, <converter>)}
+tag_converters = {key: (snap_key, _tag_converter(cast, is_list))
+                  for key, (snap_key, cast, is_list) in tag_mapping.items()}
+status_converters = {key: (snap_key, cast) for key, (snap_key, cast) in status_mapping.items()}
+
+
 # Default url handlers if MPD doesn't support 'urlhandlers' command
 urlhandlers = ['http://']
 
@@ -185,39 +234,354 @@ def send(json_msg):
     sys.stdout.flush()
 
 
+def add_watch(fd, condition, callback):
+    if using_gi_glib:
+        return GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT, condition, callback)
+    else:
+        return GLib.io_add_watch(fd, condition, callback)
+
+
+class AlbumArtCache(object):
+    """ Album art URLs found for each artist & album, kept in SQLite so they
+        survive restarts, and trimmed to the least recently used entries
+    """
+
+    # How long to remember that no album art could be found, in case it's added later
+    NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+    def __init__(self, path, max_entries):
+        self._path = path
+        self._max_entries = max_entries
+        self._db = None
+
+    @property
+    def db(self):
+        # Opened on first use, so startup doesn't wait on it
+        if self._db is None:
+            self._db = sqlite3.connect(self._path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS album_art ('
+                             'key TEXT PRIMARY KEY, url TEXT, fetched REAL, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS album_art_used ON album_art (used)')
+        return self._db
+
+    @staticmethod
+    def key(artist, album):
+        """
+        Unlike hash(), this is the same in every process.
+        """
+        return hashlib.sha1(f'{artist}\0{album}'.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Return the album art URL, '' if we already know there isn't one, or None if we don't know yet.
+        """
+        row = self.db.execute('SELECT url, fetched FROM album_art WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        url, fetched = row
+        now = time.time()
+        if url == '' and now - fetched > self.NEGATIVE_TTL:
+            return None
+        with self.db:
+            self.db.execute('UPDATE album_art SET used = ? WHERE key = ?', (now, key))
+        return url
+
+    def put(self, key, url):
+        now = time.time()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO album_art (key, url, fetched, used) VALUES (?, ?, ?, ?)',
+                            (key, url, now, now))
+            self.db.execute('DELETE FROM album_art WHERE key IN ('
+                            'SELECT key FROM album_art ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                            (self._max_entries,))
+
+
+class ArtStore(object):
+    """ Cover art image files named after the hash of their contents,
+        so every track on an album shares the one file
+    """
+
+    def __init__(self, path, base_url, max_size):
+        self.path = path
+        self.base_url = base_url
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _extension(data):
+        # MPD's albumart doesn't say what type the image is, so just go by the magic numbers
+        if data.startswith(b'\x89PNG'):
+            return 'png'
+        elif data[:4] == b'GIF8':
+            return 'gif'
+        elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return 'webp'
+        return 'jpg'
+
+    def put(self, data):
+        """
+        Store the image if it's not already there, and return the URL it's served at.
+        """
+        filename = f'{hashlib.sha256(data).hexdigest()}.{self._extension(data)}'
+        path = os.path.join(self.path, filename)
+        if os.path.exists(path):
+            # Mark it as recently used so prune() keeps it
+            os.utime(path)
+        else:
+            # Written to a temporary file first so the server never sends a partial image
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self.prune()
+        return self.base_url + filename
+
+    def has(self, url):
+        """
+        Whether a URL put() returned is still being served, prune() may have removed it since.
+        """
+        if not url.startswith(self.base_url):
+            return False
+        return os.path.exists(os.path.join(self.path, url[len(self.base_url):]))
+
+    def prune(self):
+        """
+        Remove the least recently used images until the store fits in max_size bytes.
+        """
+        files = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another stream's process sharing the directory got to it first
+                pass
+            total -= size
+            logger.debug(f'Pruned {path} from the art store')
+
+
+class ArtRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def end_headers(self):
+        # The filenames are content hashes, so they'll never change
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('Art server: ' + format % args)
+
+
+def start_art_server(path, port):
+    """
+    Serve the ArtStore to snapclients & Home Assistant on a background thread.
+    """
+    server = http.server.ThreadingHTTPServer(('', port), functools.partial(ArtRequestHandler, directory=path))
+    threading.Thread(target=server.serve_forever, name='art-server', daemon=True).start()
+    logger.info(f'Serving album art from {path} on port {port}')
+    return server
+
+
+def make_art_store(params):
+    """
+    Return the ArtStore for cover art from MPD, or None if nothing will be serving it,
+    so MusicBrainz is used instead of handing out URLs that go nowhere.
+    """
+    if not params['art-dir'] or not (params['serve-art'] or params['art-url']):
+        return None
+    return ArtStore(params['art-dir'],
+                    params['art-url'] or f'http://{socket.getfqdn()}:{params["art-port"]}/',
+                    params['art-dir-size'] * 1024 * 1024)
+
+
+def fetch_albumart(snapmeta):
+    """
+    Look up the album art URL on MusicBrainz & the Cover Art Archive, returning '' if there isn't any.
+    This is slow, so is only run on AlbumArtFetcher's worker threads.
+    """
+    album_key = 'musicbrainzAlbumId'
+    album_art = ''
+    try:
+        if not album_key in snapmeta:
+            mbartist = None
+            mbrelease = None
+            if 'artist' in snapmeta:
+                mbartist = snapmeta['artist'][0]
+            if 'album' in snapmeta:
+                mbrelease = snapmeta['album']
+            else:
+                if 'title' in snapmeta:
+                    mbrelease = snapmeta['title']
+
+            if mbartist is not None and mbrelease is not None:
+                logger.info(
+                    f'Querying album art for artist "{mbartist}", release: "{mbrelease}"')
+                result = musicbrainzngs.search_releases(artist=mbartist, release=mbrelease,
+                                                        limit=1)
+                if result['release-list']:
+                    snapmeta[album_key] = result['release-list'][0]['id']
+
+        if album_key in snapmeta:
+            data = musicbrainzngs.get_image_list(snapmeta[album_key])
+            for image in data["images"]:
+                if "Front" in image["types"] and image["approved"]:
+                    album_art = image["thumbnails"]["small"]
+                    logger.debug(
+                        f'{album_art} is an approved front image')
+                    break
+
+    except musicbrainzngs.musicbrainz.ResponseError as e:
+        logger.error(
+            f'Error while getting cover for {snapmeta[album_key]}: {e}')
+    return album_art
+
+
+class AlbumArtFetcher(object):
+    """ Run album art lookups on worker threads, so a slow MusicBrainz doesn't
+        hold up MPD events & snapserver's control commands on the main loop
+    """
+
+    WORKERS = 2
+    # Past this, new lookups are dropped until the workers catch up
+    QUEUE_SIZE = 16
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        # {key: [callback, ...]} queued or being looked up, only touched from the main loop.
+        # More than one stream might be waiting on the same album.
+        self._pending = {}
+        self._threads = []
+
+    def request(self, key, snapmeta, callback):
+        """
+        Look up the album art, calling callback(key, album art URL) on the main loop once it's done,
+        or callback(key, None) if the lookup failed.
+        """
+        if key in self._pending:
+            if callback not in self._pending[key]:
+                self._pending[key].append(callback)
+            return
+        if not self._threads:
+            for i in range(self.WORKERS):
+                thread = threading.Thread(target=self._worker, name=f'albumart-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        try:
+            # Copied since the lookup adds to it
+            self._queue.put_nowait((key, dict(snapmeta)))
+        except queue.Full:
+            logger.warning('Too many album art lookups queued, skipping')
+            return
+        self._pending[key] = [callback]
+
+    def _worker(self):
+        while True:
+            key, snapmeta = self._queue.get()
+            try:
+                album_art = self._fetch(snapmeta)
+            except Exception as e:
+                logger.error(f'Album art lookup failed: {e}')
+                album_art = None
+            GLib.idle_add(self._deliver, key, album_art)
+
+    def _deliver(self, key, album_art):
+        for callback in self._pending.pop(key, []):
+            callback(key, album_art)
+        # Only run once
+        return False
+
+
+class JSONRPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
 class MPDWrapper(object):
     """ Wrapper of mpd.MPDClient to handle socket
         errors and similar
     """
 
-    def __init__(self, params):
+    # Seconds between reconnect attempts, doubling from the first until it reaches the second
+    RECONNECT_DELAY = (1, 60)
+
+    def __init__(self, params, send=send, album_art=None, art_fetcher=None, art_store=None):
+        """
+        The album art cache, lookups, & store can be shared between several MPDWrappers,
+        otherwise each gets their own.
+        """
         self.client = mpd.MPDClient()
 
         self._params = params
+        # Where JSON-RPC for snapserver goes
+        self.send = send
+        # Incomplete line of JSON-RPC from snapserver
+        self._buffer = ''
 
         self._can_single = False
         self._can_idle = False
+        self._art_commands = []
 
         self._errors = 0
         self._poll_id = None
         self._watch_id = None
+        self._reconnect_id = None
+        self._reconnect_delay = self.RECONNECT_DELAY[0]
+        # Whether snapserver has been told we're ready yet, only happens once no matter how often MPD reconnects
+        self._ready = False
         self._idling = False
 
         self._status = {}
         self._currentsong = {}
+        # Properties (other than metadata) in the last notification sent to snapserver
+        self._sent_properties = {}
+        # Position as of the last status, and when (time.monotonic()) that status was fetched
         self._position = 0
         self._time = 0
-        self._album_art_map = {}
+        self._album_art = album_art or AlbumArtCache(params['art-cache'], params['art-cache-size'])
+        self._art_fetcher = art_fetcher or AlbumArtFetcher(fetch_albumart)
+        self._art_store = art_store or make_art_store(params)
+        self._rpc_methods = {
+            'Plugin.Stream.Player.Control': self.rpc_control,
+            'Plugin.Stream.Player.SetProperty': self.rpc_set_property,
+            'Plugin.Stream.Player.GetProperties': self.rpc_get_properties,
+            'Plugin.Stream.Player.GetMetadata': self.rpc_get_metadata,
+        }
 
     def run(self):
         """
-        Try to connect to MPD; retry every 5 seconds on failure.
+        Try to connect to MPD; retry with increasing delays on failure.
         """
+        self._reconnect_id = None
         if self.my_connect():
-            GLib.timeout_add_seconds(5, self.my_connect)
-            return False
-        else:
-            return True
+            self._schedule_reconnect()
+        # Only run once, _schedule_reconnect() adds a new timeout each time
+        return False
+
+    def next_reconnect_delay(self):
+        """ How long to wait before the next connection attempt, doubling each time until one succeeds """
+        delay = self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, self.RECONNECT_DELAY[1])
+        # Jitter so all the streams don't hit MPD at the same moment after it restarts
+        return delay * random.uniform(0.5, 1.5)
+
+    def _schedule_reconnect(self):
+        if self._reconnect_id:
+            # Already waiting to reconnect
+            return
+        delay = self.next_reconnect_delay()
+        logger.debug(f'Reconnecting in {delay:.1f} seconds')
+        self._reconnect_id = GLib.timeout_add(int(delay * 1000), self.run)
 
     @property
     def connected(self):
@@ -229,7 +593,7 @@ class MPDWrapper(object):
             self._idling = False
             self._can_idle = False
             self._can_single = False
-            self._buffer = ''
+            self._art_commands = []
 
             self.client.connect(
                 self._params['mpd-host'], self._params['mpd-port'])
@@ -251,6 +615,12 @@ class MPDWrapper(object):
             # added in 0.15
             if 'single' in commands:
                 self._can_single = True
+            # Embedded art first, then cover.jpg & such from the song's directory
+            # added in 0.22 and 0.21 respectively
+            self._art_commands = [command for command in ('readpicture', 'albumart') if command in commands]
+            # added in 0.22.4, fewer round-trips for each image
+            if 'binarylimit' in commands:
+                self.client.binarylimit(1024 * 1024)
 
             if self._errors > 0:
                 logger.info('Reconnected to MPD server.')
@@ -263,38 +633,37 @@ class MPDWrapper(object):
             # Init internal state to throw events at start
             self.init_state()
 
-            # Add periodic status check for sending MPRIS events
-            if not self._poll_id:
-                interval = 15 if self._can_idle else 1
+            # Idle events are all we need to keep up to date,
+            # only poll for changes if asked to, or if there's no other option.
+            # Any watches from the previous connection were removed by reconnect()
+            interval = self._params['poll-interval']
+            if interval is None and not self._can_idle:
+                interval = 1
+            if interval:
                 self._poll_id = GLib.timeout_add_seconds(interval,
                                                          self.timer_callback)
-            if self._can_idle and not self._watch_id:
-                if using_gi_glib:
-                    self._watch_id = GLib.io_add_watch(self,
-                                                       GLib.PRIORITY_DEFAULT,
-                                                       GLib.IO_IN | GLib.IO_HUP,
-                                                       self.socket_callback)
-                else:
-                    self._watch_id = GLib.io_add_watch(self,
-                                                       GLib.IO_IN | GLib.IO_HUP,
-                                                       self.socket_callback)
-
-            flags = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
-            flags |= os.O_NONBLOCK
-            fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, flags)
-            GLib.io_add_watch(sys.stdin, GLib.IO_IN |
-                              GLib.IO_HUP, self.io_callback)
+            if self._can_idle:
+                self._watch_id = add_watch(self, GLib.IO_IN | GLib.IO_HUP, self.socket_callback)
 
             # Reset error counter
             self._errors = 0
 
-            self.timer_callback()
-            self.idle_enter()
-            send({"jsonrpc": "2.0", "method": "Plugin.Stream.Ready"})
+            # This enters idle once it's done.
+            # After a reconnect it's diffed against what snapserver already has, so only what changed meanwhile is sent.
+            if not self.timer_callback():
+                # It's already called reconnect()
+                return True
+            # Only reset the backoff once it's actually working, in case MPD keeps dropping the connection straight away
+            self._reconnect_delay = self.RECONNECT_DELAY[0]
+            if not self._ready:
+                self._ready = True
+                self.send({"jsonrpc": "2.0", "method": "Plugin.Stream.Ready"})
 
             # Return False to stop trying to connect
             return False
-        except socket.error as e:
+        except (socket.error, mpd.ConnectionError) as e:
+            # Might've gotten partway
+            self.disconnect()
             self._errors += 1
             if self._errors < 6:
                 logger.error('Could not connect to MPD: %s' % e)
@@ -303,27 +672,41 @@ class MPDWrapper(object):
             return True
 
     def reconnect(self):
+        if self._reconnect_id:
+            # Something else already noticed
+            return
         logger.warning("Disconnected")
 
+        # Anything watching the old connection would only trigger more reconnects
+        for source_id in (self._poll_id, self._watch_id):
+            if source_id:
+                GLib.source_remove(source_id)
+        self._poll_id = self._watch_id = None
+
         # Clean mpd client state
-        try:
-            self.disconnect()
-        except:
-            self.disconnect()
+        self.disconnect()
 
         # Try to reconnect
-        self.run()
+        self._schedule_reconnect()
 
     def disconnect(self):
-        self.client.disconnect()
+        self._idling = False
+        try:
+            self.client.disconnect()
+        except (socket.error, mpd.ConnectionError):
+            pass
 
     def init_state(self):
+        if self._ready:
+            # Reconnecting, keep the state from before the disconnect to diff against
+            return
         # Get current state
         self._status = self.client.status()
         # Invalid some fields to throw events at start
         self._status['state'] = 'invalid'
         self._status['songid'] = '-1'
         self._position = 0
+        self._sent_properties = {}
 
     def idle_enter(self):
         if not self._can_idle:
@@ -355,146 +738,195 @@ class MPDWrapper(object):
 
     def timer_callback(self):
         try:
-            was_idle = self.idle_leave()
-        except (socket.error, mpd.MPDError, socket.timeout):
-            logger.error('')
+            # Leaves & re-enters idle itself, in the same write as the status & currentsong
+            self._update_properties(force=False)
+        except (socket.error, mpd.MPDError, socket.timeout) as ex:
+            logger.error(f'Failed to update properties: {ex!r}')
             self.reconnect()
             return False
-        self._update_properties(force=False)
-        if was_idle:
-            self.idle_enter()
         return True
 
-    def control(self, cmd):
+    def _control_seek(self, params):
+        offset = float(params['offset'])
+        strOffset = str(offset)
+        if offset >= 0:
+            strOffset = "+" + strOffset
+        self.seekcur(strOffset)
+
+    def _control_set_position(self, params):
+        position = float(params['position'])
+        logger.info(f'setPosition {position}')
+        self.seekcur(position)
+
+    def _control_play_pause(self, params):
+        # Idle events keep this up to date, no need to ask MPD
+        if self._status.get('state') == 'play':
+            self.pause(1)
+        else:
+            self.play()
+
+    def rpc_control(self, request_params):
+        command = request_params['command']
+        params = request_params.get('params', {})
+        logger.debug('Control command: %s, params: %s', command, params)
+        handler = {
+            'next': lambda params: self.next(),
+            'previous': lambda params: self.previous(),
+            'play': lambda params: self.play(),
+            'pause': lambda params: self.pause(1),
+            'playPause': self._control_play_pause,
+            'stop': lambda params: self.stop(),
+            'setPosition': self._control_set_position,
+            'seek': self._control_seek,
+        }.get(command)
+        if handler is None:
+            raise JSONRPCError(-32602, f"Unknown command {command}")
+        handler(params)
+        return "ok"
+
+    def rpc_set_property(self, property):
+        logger.info(f'SetProperty: {property}')
+        # Sent to MPD all at once, rather than a round-trip for each
+        commands = []
+        if 'shuffle' in property:
+            commands.append(('random', int(property['shuffle'])))
+        if 'loopStatus' in property:
+            value = property['loopStatus']
+            if value == "playlist":
+                commands.append(('repeat', 1))
+                if self._can_single:
+                    commands.append(('single', 0))
+            elif value == "track":
+                if self._can_single:
+                    commands.append(('repeat', 1))
+                    commands.append(('single', 1))
+            elif value == "none":
+                commands.append(('repeat', 0))
+                if self._can_single:
+                    commands.append(('single', 0))
+        if 'volume' in property:
+            commands.append(('setvol', int(property['volume'])))
+        if commands:
+            self.batch(commands)
+        return "ok"
+
+    def rpc_get_properties(self, params):
+        snapstatus = self._get_properties(self._status)
+        if 'position' in snapstatus:
+            snapstatus['position'] = self.estimated_position()
+        logger.info(f'Snapstatus: {snapstatus}')
+        return snapstatus
+
+    def rpc_get_metadata(self, params):
+        self.send({"jsonrpc": "2.0", "method": "Plugin.Stream.Log", "params": {
+             "severity": "Info", "message": "Logmessage"}})
+        raise JSONRPCError(-32601, "TODO: GetMetadata not yet implemented")
+
+    def handle_request(self, request):
+        """
+        Run a single JSON-RPC request, returning the response, or None if it was a notification.
+        """
+        id = None
         try:
-            request = json.loads(cmd)
-            id = request['id']
-            [interface, cmd] = request['method'].rsplit('.', 1)
-            if interface == 'Plugin.Stream.Player':
-                if cmd == 'Control':
-                    success = True
-                    command = request['params']['command']
-                    params = request['params'].get('params', {})
-                    logger.debug(
-                        f'Control command: {command}, params: {params}')
-                    if command == 'next':
-                        self.next()
-                    elif command == 'previous':
-                        self.previous()
-                    elif command == 'play':
-                        self.play()
-                    elif command == 'pause':
-                        self.pause(1)
-                    elif command == 'playPause':
-                        if self.status()['state'] == 'play':
-                            self.pause(1)
-                        else:
-                            self.play()
-                    elif command == 'stop':
-                        self.stop()
-                    elif command == 'setPosition':
-                        position = float(params['position'])
-                        logger.info(f'setPosition {position}')
-                        self.seekcur(position)
-                    elif command == 'seek':
-                        offset = float(params['offset'])
-                        strOffset = str(offset)
-                        if offset >= 0:
-                            strOffset = "+" + strOffset
-                        self.seekcur(strOffset)
-                elif cmd == 'SetProperty':
-                    property = request['params']
-                    logger.info(f'SetProperty: {property}')
-                    if 'shuffle' in property:
-                        self.random(int(property['shuffle']))
-                    if 'loopStatus' in property:
-                        value = property['loopStatus']
-                        if value == "playlist":
-                            self.repeat(1)
-                            if self._can_single:
-                                self.single(0)
-                        elif value == "track":
-                            if self._can_single:
-                                self.repeat(1)
-                                self.single(1)
-                        elif value == "none":
-                            self.repeat(0)
-                            if self._can_single:
-                                self.single(0)
-                    if 'volume' in property:
-                        self.setvol(int(property['volume']))
-                elif cmd == 'GetProperties':
-                    snapstatus = self._get_properties(self.status())
-                    logger.info(f'Snapstatus: {snapstatus}')
-                    return send({"jsonrpc": "2.0", "id": id, "result": snapstatus})
-                    # return send({"jsonrpc": "2.0", "error": {"code": -32601,
-                    #                                          "message": "TODO: GetProperties not yet implemented"}, "id": id})
-                elif cmd == 'GetMetadata':
-                    send({"jsonrpc": "2.0", "method": "Plugin.Stream.Log", "params": {
-                         "severity": "Info", "message": "Logmessage"}})
-                    return send({"jsonrpc": "2.0", "error": {"code": -32601,
-                                                             "message": "TODO: GetMetadata not yet implemented"}, "id": id})
-                else:
-                    return send({"jsonrpc": "2.0", "error": {"code": -32601,
-                                                             "message": "Method not found"}, "id": id})
-            else:
-                return send({"jsonrpc": "2.0", "error": {"code": -32601,
-                                                         "message": "Method not found"}, "id": id})
-            send({"jsonrpc": "2.0", "result": "ok", "id": id})
-        except Exception as e:
-            send({"jsonrpc": "2.0", "error": {
-                 "code": -32700, "message": "Parse error", "data": str(e)}, "id": id})
+            if not isinstance(request, dict):
+                raise JSONRPCError(-32600, "Invalid Request")
+            id = request.get('id')
+            method = self._rpc_methods.get(request.get('method'))
+            if method is None:
+                raise JSONRPCError(-32601, "Method not found")
+            response = {"jsonrpc": "2.0", "result": method(request.get('params', {})), "id": id}
+        except JSONRPCError as e:
+            response = {"jsonrpc": "2.0", "error": {"code": e.code, "message": e.message}, "id": id}
+        except (KeyError, ValueError, TypeError) as e:
+            response = {"jsonrpc": "2.0", "error": {
+                "code": -32602, "message": "Invalid params", "data": str(e)}, "id": id}
+        if isinstance(request, dict) and 'id' not in request:
+            # Notifications don't get a response
+            return None
+        return response
+
+    def control(self, line):
+        """
+        Handle a line of JSON-RPC from snapserver, which may be a batch of requests.
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return self.send({"jsonrpc": "2.0", "error": {
+                "code": -32700, "message": "Parse error", "data": str(e)}, "id": None})
+
+        if isinstance(request, list):
+            if not request:
+                return self.send({"jsonrpc": "2.0", "error": {"code": -32600, "message": "Invalid Request"}, "id": None})
+            responses = [response for response in map(self.handle_request, request) if response is not None]
+            # All the responses go back in one write
+            if responses:
+                self.send(responses)
+        else:
+            response = self.handle_request(request)
+            if response is not None:
+                self.send(response)
 
     def io_callback(self, fd, event):
-        logger.debug("IO event %r on fd %r" % (event, fd))
+        logger.debug("IO event %r on fd %r", event, fd)
         if event & GLib.IO_HUP:
             logger.debug("IO_HUP")
             return True
         elif event & GLib.IO_IN:
-            chunk = fd.read()
-            for char in chunk:
-                if char == '\n':
-                    logger.info(f'Received: {self._buffer}')
-                    self.control(self._buffer)
-                    self._buffer = ''
-                else:
-                    self._buffer += char
+            self.feed(fd.read())
             return True
 
+    def feed(self, data):
+        """
+        Handle a chunk of JSON-RPC lines from snapserver.
+        Only the incomplete line at the end is kept for next time.
+        """
+        *lines, self._buffer = (self._buffer + data).split('\n')
+        for line in lines:
+            if not line.strip():
+                continue
+            logger.info('Received: %s', line)
+            self.control(line)
+
     def socket_callback(self, fd, event):
         try:
-            logger.debug("Socket event %r on fd %r" % (event, fd))
+            logger.debug("Socket event %r on fd %r", event, fd)
             if event & GLib.IO_HUP:
                 self.reconnect()
-                return True
+                return False
             elif event & GLib.IO_IN:
                 if self._idling:
                     self._idling = False
                     data = fd._fetch_objects("changed")
-                    logger.debug("Idle events: %r" % data)
-                    updated = False
-                    for item in data:
-                        subsystem = item["changed"]
-                        # subsystem list: <http://www.musicpd.org/doc/protocol/ch03.html>
-                        if subsystem in ("player", "mixer", "options", "playlist"):
-                            if not updated:
-                                logger.info(f'Subsystem: {subsystem}')
-                                self._update_properties(force=True)
-                                updated = True
-                    self.idle_enter()
+                    logger.debug("Idle events: %r", data)
+                    # subsystem list: <http://www.musicpd.org/doc/protocol/ch03.html>
+                    subsystems = {item["changed"] for item in data} & {"player", "mixer", "options", "playlist"}
+                    if subsystems:
+                        logger.info(f'Subsystems: {subsystems}')
+                        # Re-enters idle in the same write as the status & currentsong
+                        self._update_properties(force=True, subsystems=subsystems)
+                    else:
+                        self.idle_enter()
             return True
         except:
-            logger.error('Exception in socket_callback')
+            logger.exception('Exception in socket_callback')
             self.reconnect()
-            return True
+            return False
 
     def __track_key(self, snapmeta):
-        return hash(snapmeta.get('artist', [''])[0] + snapmeta.get('album', snapmeta.get('title', '')))
+        return AlbumArtCache.key(snapmeta.get('artist', [''])[0], snapmeta.get('album', snapmeta.get('title', '')))
 
     def get_albumart(self, snapmeta, cached):
-        album_key = 'musicbrainzAlbumId'
+        """
+        Return the album art URL if it's already known.
+        Otherwise, unless only checking the cache, start looking it up in the background.
+        """
         track_key = self.__track_key(snapmeta)
-        album_art = self._album_art_map.get(track_key)
+        album_art = self._album_art.get(track_key)
+        if album_art and self._art_store is not None and album_art.startswith(self._art_store.base_url) \
+                and not self._art_store.has(album_art):
+            # The image has been pruned from the ArtStore, get it from MPD again
+            album_art = None
         if album_art is not None:
             if album_art == '':
                 return None
@@ -504,44 +936,59 @@ class MPDWrapper(object):
         if cached:
             return None
 
-        self._album_art_map[track_key] = ''
-        try:
-            if not album_key in snapmeta:
-                mbartist = None
-                mbrelease = None
-                if 'artist' in snapmeta:
-                    mbartist = snapmeta['artist'][0]
-                if 'album' in snapmeta:
-                    mbrelease = snapmeta['album']
-                else:
-                    if 'title' in snapmeta:
-                        mbrelease = snapmeta['title']
-
-                if mbartist is not None and mbrelease is not None:
-                    logger.info(
-                        f'Querying album art for artist "{mbartist}", release: "{mbrelease}"')
-                    result = musicbrainzngs.search_releases(artist=mbartist, release=mbrelease,
-                                                            limit=1)
-                    if result['release-list']:
-                        snapmeta[album_key] = result['release-list'][0]['id']
-
-            if album_key in snapmeta:
-                data = musicbrainzngs.get_image_list(snapmeta[album_key])
-                for image in data["images"]:
-                    if "Front" in image["types"] and image["approved"]:
-                        album_art = image["thumbnails"]["small"]
-                        logger.debug(
-                            f'{album_art} is an approved front image')
-                        self._album_art_map[track_key] = album_art
-                        break
-
-        except musicbrainzngs.musicbrainz.ResponseError as e:
-            logger.error(
-                f'Error while getting cover for {snapmeta[album_key]}: {e}')
-        album_art = self._album_art_map[track_key]
-        if album_art == '':
+        album_art = self.get_local_albumart(snapmeta.get('url'))
+        if album_art is not None:
+            self._album_art.put(track_key, album_art)
+            return album_art
+
+        self._art_fetcher.request(track_key, snapmeta, self._albumart_found)
+        return None
+
+    def get_local_albumart(self, uri):
+        """
+        Get the song's cover art from MPD itself, store it in the ArtStore, and return the URL it's served at.
+        """
+        if self._art_store is None or not uri or '://' in uri:
+            # Web radio & such won't have any
             return None
-        return album_art
+        for command in self._art_commands:
+            was_idle = self.idle_leave()
+            try:
+                # python-mpd2 fetches it in binarylimit sized chunks until it has the whole image
+                picture = getattr(self.client, command)(uri)
+            except mpd.CommandError as e:
+                logger.debug(f'No {command} for {uri}: {e}')
+                picture = {}
+            finally:
+                if was_idle:
+                    self.idle_enter()
+            if picture.get('binary'):
+                logger.info(f'Found {command} for {uri}')
+                return self._art_store.put(picture['binary'])
+        return None
+
+    def _albumart_found(self, track_key, album_art):
+        if album_art is None:
+            # Lookup failed, try again next time this album comes up
+            return
+        self._album_art.put(track_key, album_art)
+        if album_art == '':
+            return
+
+        if self.get_metadata().get('artUrl') != album_art:
+            # Song has changed since the lookup started
+            return
+        self.send_properties()
+
+    def send_properties(self):
+        """
+        Send snapserver all the current properties & metadata, as best we know them without asking MPD.
+        """
+        snapstatus = self._get_properties(self._status)
+        if 'position' in snapstatus:
+            snapstatus['position'] = self.estimated_position()
+        snapstatus['metadata'] = self.get_metadata()
+        self.send({"jsonrpc": "2.0", "method": "Plugin.Stream.Player.Properties", "params": snapstatus})
 
     def get_metadata(self):
         """
@@ -549,33 +996,23 @@ class MPDWrapper(object):
         http://www.freedesktop.org/wiki/Specifications/mpris-spec/metadata
         """
 
-        mpd_meta = self._currentsong.copy()
-        logger.debug(f'mpd meta: {mpd_meta}')
+        # Not modified here, so no need to copy it
+        mpd_meta = self._currentsong
+        logger.debug('mpd meta: %s', mpd_meta)
         snapmeta = {}
         for key, values in mpd_meta.items():
+            converter = tag_converters.get(key)
+            if converter is None:
+                logger.debug('tag "%s" not supported', key)
+                continue
+            if type(values) == list and len(values) == 0:
+                continue
+            snap_key, convert = converter
             try:
-                value = {}
-                if type(values) == list:
-                    if len(values) == 0:
-                        continue
-                    if tag_mapping[key][2]:
-                        value = list(map(type(tag_mapping[key][1]), values))
-                    else:
-                        value = tag_mapping[key][1](values[0])
-                else:
-                    if tag_mapping[key][2]:
-                        value = [tag_mapping[key][1](values)]
-                    else:
-                        value = tag_mapping[key][1](values)
-                snapmeta[tag_mapping[key][0]] = value
-                logger.debug(
-                    f'key: {key}, value: {value}, mapped key: {tag_mapping[key][0]}, mapped value: {snapmeta[tag_mapping[key][0]]}')
-            except KeyError:
-                logger.debug(f'tag "{key}" not supported')
+                snapmeta[snap_key] = convert(values)
             except (ValueError, TypeError):
-                logger.warning(
-                    f"Can't cast value {value} to {tag_mapping[key][1]}")
-        logger.debug(f'snapcast meta: {snapmeta}')
+                logger.warning("Can't cast value %s for %s", values, key)
+        logger.debug('snapcast meta: %s', snapmeta)
 
         # Hack for web radio:
         # "name" and "title" are set, but not "album" and not "artist"
@@ -614,17 +1051,15 @@ class MPDWrapper(object):
     def _get_properties(self, mpd_status):
         snapstatus = {}
         for key, value in mpd_status.items():
+            converter = status_converters.get(key)
+            if converter is None:
+                logger.debug('property "%s" not supported', key)
+                continue
+            mapped_key, convert = converter
             try:
-                mapped_key = status_mapping[key][0]
-                mapped_val = status_mapping[key][1](value)
-                snapstatus[mapped_key] = mapped_val
-                logger.debug(
-                    f'key: {key}, value: {value}, mapped key: {mapped_key}, mapped value: {mapped_val}')
-            except KeyError:
-                logger.debug(f'property "{key}" not supported')
-            except (ValueError, TypeError):
-                logger.warning(
-                    f"Can't cast value {value} to {status_mapping[key][1]}")
+                snapstatus[mapped_key] = convert(value)
+            except (ValueError, TypeError, KeyError):
+                logger.warning("Can't cast value %s for %s", value, key)
 
         snapstatus['canGoNext'] = True
         snapstatus['canGoPrevious'] = True
@@ -634,17 +1069,37 @@ class MPDWrapper(object):
         snapstatus['canControl'] = True
         return snapstatus
 
-    def _update_properties(self, force=False):
-        logger.debug(f'update_properties force: {force}')
+    def estimated_position(self):
+        """
+        Work out the current position from the last status, rather than asking MPD for it again.
+        MPD doesn't send any events as a song plays, only when something changes.
+        """
+        if self._status.get('state') != 'play':
+            return self._position
+        position = self._position + (time.monotonic() - self._time)
+        if 'duration' in self._status:
+            position = min(position, float(self._status['duration']))
+        return position
+
+    def _update_properties(self, force=False, subsystems=None):
+        """
+        Fetch whatever the changed subsystems could've affected, and send on anything that actually changed.
+        With no subsystems, such as when polling, fetch everything.
+        """
+        logger.debug('update_properties force: %s, subsystems: %s', force, subsystems)
         old_position = self._position
         old_time = self._time
 
-        new_song = self.client.currentsong()
-        if not new_song:
-            logger.warning("_update_properties: failed to get current song")
-            new_song = {}
+        # "mixer" & "options" only affect the status, the song can only change with "player" or "playlist"
+        if subsystems is None or subsystems & {"player", "playlist"}:
+            new_status, new_song = self.command_batch([('status',), ('currentsong',)])
+            if not new_song:
+                logger.warning("_update_properties: failed to get current song")
+                new_song = {}
+        else:
+            new_status, = self.command_batch([('status',)])
+            new_song = self._currentsong
 
-        new_status = self.client.status()
         if not new_status:
             logger.warning("_update_properties: failed to get new status")
             new_status = {}
@@ -661,9 +1116,9 @@ class MPDWrapper(object):
             logger.debug('nothing to do')
             return
 
-        logger.info(
-            f'new status: {new_status}, changed_status: {changed_status}, changed_song: {changed_song}')
-        self._time = new_time = int(time.time())
+        logger.info('new status: %s, changed_status: %s, changed_song: %s',
+                    new_status, changed_status, changed_song)
+        self._time = new_time = time.monotonic()
 
         snapstatus = self._get_properties(new_status)
 
@@ -685,27 +1140,36 @@ class MPDWrapper(object):
                 expected_position = old_position + (new_time - old_time)
             else:
                 expected_position = old_position
-            if abs(new_position - expected_position) > 0.6:
-                logger.debug("Expected pos %r, actual %r, diff %r" % (
-                    expected_position, new_position, new_position - expected_position))
-                logger.debug("Old position was %r at %r (%r seconds ago)" % (
-                    old_position, old_time, new_time - old_time))
+            seeked = abs(new_position - expected_position) > 0.6
+            if seeked:
+                logger.debug("Expected pos %r, actual %r, diff %r",
+                             expected_position, new_position, new_position - expected_position)
+                logger.debug("Old position was %r at %r (%r seconds ago)",
+                             old_position, old_time, new_time - old_time)
                 # self._dbus_service.Seeked(new_position * 1000000)
 
+            # MPD's status changes constantly while playing (bitrate, time, etc.) without anything we send changing.
+            # Snapserver replaces all the properties (other than metadata) with each notification,
+            # so it's all or nothing, but if nothing but the position changed, and that's where it was expected to be,
+            # it's nothing.
+            if not seeked and ({key: value for key, value in snapstatus.items() if key != 'position'} ==
+                               {key: value for key, value in self._sent_properties.items() if key != 'position'}):
+                logger.debug('Only the position changed, as expected')
+                return
+
         else:
             # Update current song metadata
             snapstatus["metadata"] = self.get_metadata()
-
-        send({"jsonrpc": "2.0", "method": "Plugin.Stream.Player.Properties",
-             "params": snapstatus})
-
-        if new_song:
             if 'artUrl' not in snapstatus['metadata']:
+                # Art from MPD is quick enough to wait for,
+                # otherwise this sends the Properties again once it's been found online
                 album_art = self.get_albumart(snapstatus['metadata'], False)
                 if album_art is not None:
                     snapstatus['metadata']['artUrl'] = album_art
-                    send(
-                        {"jsonrpc": "2.0", "method": "Plugin.Stream.Player.Properties", "params": snapstatus})
+
+        self._sent_properties = {key: value for key, value in snapstatus.items() if key != 'metadata'}
+        self.send({"jsonrpc": "2.0", "method": "Plugin.Stream.Player.Properties",
+                   "params": snapstatus})
 
     # Compatibility functions
 
@@ -761,6 +1225,89 @@ class MPDWrapper(object):
         def _fetch_objects(self, *args):
             return self.client._getobjects(*args)
 
+    # Command lists are sent & parsed by hand, so that leaving idle, the command list, and re-entering idle
+    # can all go out in a single write, with a single round-trip for all the responses.
+    # python-mpd2's own command_list_ok_begin() can't do that since idle isn't allowed within a command list.
+    #
+    # The lines are still read with the client's own method, which knows how it's buffering the socket,
+    # and raises the usual errors for ACK & lost connections. It gives None for the final OK.
+
+    if hasattr(mpd.MPDClient, "_read_line"):
+        def _read_line(self):
+            return self.client._read_line()
+    elif hasattr(mpd.MPDClient, "_readline"):
+        def _read_line(self):
+            return self.client._readline()
+
+    @staticmethod
+    def _format_command(command, *args):
+        quoted = ['"%s"' % str(arg).replace('\\', '\\\\').replace('"', '\\"') for arg in args]
+        return ' '.join([command] + quoted)
+
+    def _read_command_list(self):
+        """
+        Read the response to a command_list_ok_begin list, returning a dict for each command.
+        Keys are lowercased and repeated keys (such as multiple artists) become lists, same as python-mpd2 does.
+        """
+        results = []
+        current = {}
+        while True:
+            line = self._read_line()
+            if line is None:
+                return results
+            elif line == 'list_OK':
+                results.append(current)
+                current = {}
+            else:
+                key, value = line.split(': ', 1)
+                key = key.lower()
+                if key not in current:
+                    current[key] = value
+                elif isinstance(current[key], list):
+                    current[key].append(value)
+                else:
+                    current[key] = [current[key], value]
+
+    def command_batch(self, commands):
+        """
+        Send (command, *args) tuples to MPD as a single command list, all in one write
+        along with leaving & re-entering idle, and return each command's response.
+        """
+        lines = []
+        was_idle = self._idling
+        if was_idle:
+            lines.append('noidle')
+        lines.append('command_list_ok_begin')
+        lines.extend(self._format_command(*command) for command in commands)
+        lines.append('command_list_end')
+        if self._can_idle:
+            lines.append('idle')
+        logger.debug('Sending command list %s', lines)
+        self.client._wfile.write(''.join(line + '\n' for line in lines))
+        self.client._wfile.flush()
+
+        if was_idle:
+            # Response to the noidle, which is the same as any other idle response.
+            # Anything that changed will be covered by these commands anyway.
+            self._idling = False
+            self._fetch_object()
+        try:
+            return self._read_command_list()
+        finally:
+            # MPD still gets to the idle even if a command in the list fails
+            self._idling = self._can_idle
+
+    def batch(self, commands):
+        """
+        Same as command_batch(), but reconnect on errors like call() does.
+        """
+        try:
+            return self.command_batch(commands)
+        except (socket.error, mpd.MPDError, socket.timeout) as ex:
+            logger.debug("Trying to reconnect, got %r" % ex)
+            self.reconnect()
+            return False
+
     # Wrapper to catch connection errors when calling mpd client methods.
 
     def __getattr__(self, attr):
@@ -772,8 +1319,8 @@ class MPDWrapper(object):
         fn = getattr(self.client, command)
         try:
             was_idle = self.idle_leave()
-            logger.debug("Sending command %r (was idle? %r)" %
-                         (command, was_idle))
+            logger.debug("Sending command %r (was idle? %r)",
+                         command, was_idle)
             r = fn(*args)
             if was_idle:
                 self.idle_enter()
@@ -784,6 +1331,110 @@ class MPDWrapper(object):
             return False
 
 
+class Multiplexer(object):
+    """ Run an MPDWrapper for each of several streams in the one process,
+        sharing the album art cache, lookups, & store between them.
+        Snapserver still runs a controlscript for each stream,
+        which just relays its JSON-RPC to & from here over a Unix socket, see meta_relay.py
+    """
+
+    def __init__(self, params, streams):
+        """
+        streams is {stream id: (mpd host, mpd port, mpd password)}
+        """
+        self._path = params['serve']
+        # {stream id: [relay socket, ...]}
+        self._relays = {stream: [] for stream in streams}
+
+        album_art = AlbumArtCache(params['art-cache'], params['art-cache-size'])
+        art_fetcher = AlbumArtFetcher(fetch_albumart)
+        art_store = make_art_store(params)
+
+        self.wrappers = {}
+        for stream, (host, port, password) in streams.items():
+            stream_params = dict(params, **{'mpd-host': host, 'mpd-port': port, 'mpd-password': password,
+                                            'stream': stream})
+            self.wrappers[stream] = MPDWrapper(stream_params, send=functools.partial(self.send, stream),
+                                               album_art=album_art, art_fetcher=art_fetcher, art_store=art_store)
+
+    def run(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._path)
+        self._server.listen()
+        add_watch(self._server, GLib.IO_IN, self._accept)
+        logger.info(f'Serving streams {list(self.wrappers)} on {self._path}')
+
+        for wrapper in self.wrappers.values():
+            wrapper.run()
+
+    def send(self, stream, json_msg):
+        line = (json.dumps(json_msg) + '\n').encode()
+        for relay in list(self._relays[stream]):
+            try:
+                relay.sendall(line)
+            except OSError as e:
+                logger.warning(f'Lost relay for {stream}: {e}')
+                self._relays[stream].remove(relay)
+                relay.close()
+
+    def _accept(self, fd, event):
+        relay, _ = self._server.accept()
+        # The first line says which stream the relay is for, everything after that is JSON-RPC
+        # Decoded incrementally, as a multi-byte character can be split across reads
+        state = {'stream': None, 'buffer': b'', 'decoder': codecs.getincrementaldecoder('utf-8')(errors='replace')}
+        add_watch(relay, GLib.IO_IN | GLib.IO_HUP,
+                  lambda fd, event: self._relay_callback(relay, state))
+        return True
+
+    def _relay_callback(self, relay, state):
+        data = relay.recv(64 * 1024)
+        if not data:
+            if state['stream'] is not None:
+                logger.info(f'Relay for {state["stream"]} disconnected')
+                self._relays[state['stream']].remove(relay)
+            relay.close()
+            return False
+
+        if state['stream'] is None:
+            state['buffer'] += data
+            if b'\n' not in state['buffer']:
+                return True
+            hello, data = state['buffer'].split(b'\n', 1)
+            try:
+                stream = json.loads(hello)['stream']
+            except (ValueError, KeyError, TypeError):
+                stream = None
+            if stream not in self.wrappers:
+                logger.warning(f'Relay for unknown stream {hello}')
+                relay.close()
+                return False
+            logger.info(f'Relay for {stream} connected')
+            state['stream'] = stream
+            self._relays[stream].append(relay)
+            wrapper = self.wrappers[stream]
+            if wrapper.connected:
+                # Catch up this snapserver on what it missed
+                self.send(stream, {"jsonrpc": "2.0", "method": "Plugin.Stream.Ready"})
+                wrapper.send_properties()
+
+        self.wrappers[state['stream']].feed(state['decoder'].decode(data))
+        return True
+
+
+def parse_mpd_stream(arg):
+    """
+    Parse --mpd-stream's ID=[PASSWORD@]HOST:PORT into (stream id, (host, port, password))
+    """
+    stream, address = arg.split('=', 1)
+    password = None
+    if '@' in address:
+        password, address = address.rsplit('@', 1)
+    host, port = address.rsplit(':', 1)
+    return stream, (host, int(port), password)
+
+
 def usage(params):
     print("""\
 Usage: %(progname)s [OPTION]...
@@ -793,6 +1444,24 @@ Usage: %(progname)s [OPTION]...
      --snapcast-host=ADDR   Set the snapcast server address
      --snapcast-port=PORT   Set the snapcast server port
      --stream=ID            Set the stream id
+     --poll-interval=SECS   Also poll MPD for changes every SECS seconds,
+                            normally only done if MPD doesn't support idle
+     --art-cache=PATH       SQLite database to cache album art URLs in
+     --art-cache-size=N     Maximum number of albums to cache art for
+     --art-dir=PATH         Where to keep cover art fetched from MPD
+     --art-dir-size=MB      Maximum size of that directory
+     --serve-art            Serve that cover art over HTTP, only one process
+                            sharing the directory should do this
+     --art-port=PORT        Port to serve that cover art on
+     --art-url=URL          URL that port is reachable at by snapclients,
+                            cover art from MPD is only used with this or --serve-art
+
+   Handling several streams in one process:
+     --serve=PATH           Run one MPD connection per --mpd-stream,
+                            taking JSON-RPC on this Unix socket from meta_relay.py,
+                            which is then each stream's controlscript
+     --mpd-stream=ID=[PASSWORD@]HOST:PORT
+                            An MPD instance for --serve, can be repeated
 
      -d, --debug            Run in debug mode
      -v, --version          meta_mpd version
@@ -809,11 +1478,13 @@ if __name__ == '__main__':
     log_format_stderr = '%(asctime)s %(module)s %(levelname)s: %(message)s'
 
     log_level = logging.INFO
+    # {stream id: (mpd host, mpd port, mpd password)} for --serve
+    mpd_streams = {}
 
     # Parse command line
     try:
         (opts, args) = getopt.getopt(sys.argv[1:], 'hdjv',
-                                     ['help', 'mpd-host=', 'mpd-port=', 'snapcast-host=', 'snapcast-port=', 'stream=', 'debug', 'version'])
+                                     ['help', 'mpd-host=', 'mpd-port=', 'snapcast-host=', 'snapcast-port=', 'stream=', 'poll-interval=', 'art-cache=', 'art-cache-size=', 'art-dir=', 'art-dir-size=', 'art-port=', 'art-url=', 'serve-art', 'serve=', 'mpd-stream=', 'debug', 'version'])
     except getopt.GetoptError as ex:
         (msg, opt) = ex.args
         print("%s: %s" % (sys.argv[0], msg), file=sys.stderr)
@@ -835,6 +1506,27 @@ if __name__ == '__main__':
             params['snapcast-port'] = int(arg)
         elif opt in ['--stream']:
             params['stream'] = arg
+        elif opt in ['--poll-interval']:
+            params['poll-interval'] = int(arg)
+        elif opt in ['--art-cache']:
+            params['art-cache'] = arg
+        elif opt in ['--art-cache-size']:
+            params['art-cache-size'] = int(arg)
+        elif opt in ['--art-dir']:
+            params['art-dir'] = arg
+        elif opt in ['--art-dir-size']:
+            params['art-dir-size'] = int(arg)
+        elif opt in ['--art-port']:
+            params['art-port'] = int(arg)
+        elif opt in ['--art-url']:
+            params['art-url'] = arg
+        elif opt in ['--serve-art']:
+            params['serve-art'] = True
+        elif opt in ['--serve']:
+            params['serve'] = arg
+        elif opt in ['--mpd-stream']:
+            stream, mpd_stream = parse_mpd_stream(arg)
+            mpd_streams[stream] = mpd_stream
         elif opt in ['-d', '--debug']:
             log_level = logging.DEBUG
         elif opt in ['-v', '--version']:
@@ -848,7 +1540,6 @@ if __name__ == '__main__':
         usage(params)
         sys.exit()
 
-    logger = logging.getLogger('meta_mpd')
     logger.propagate = False
     logger.setLevel(log_level)
 
@@ -858,7 +1549,7 @@ if __name__ == '__main__':
 
     logger.addHandler(log_handler)
 
-    for p in ['mpd-host', 'mpd-port', 'snapcast-host', 'snapcast-port', 'mpd-password', 'stream']:
+    for p in ['mpd-host', 'mpd-port', 'snapcast-host', 'snapcast-port', 'mpd-password', 'stream', 'art-cache', 'art-cache-size', 'art-dir', 'art-dir-size', 'art-port']:
         if not params[p]:
             params[p] = defaults[p]
 
@@ -877,9 +1568,28 @@ if __name__ == '__main__':
         logger.debug('Using legacy pygobject2 main loop.')
     loop = GLib.MainLoop()
 
-    # Create wrapper to handle connection failures with MPD more gracefully
-    mpd_wrapper = MPDWrapper(params)
-    mpd_wrapper.run()
+    if params['art-dir'] and params['serve-art']:
+        try:
+            start_art_server(params['art-dir'], params['art-port'])
+        except OSError as e:
+            # Probably another process is already serving it, the URLs are the same either way
+            logger.warning(f'Not serving album art on port {params["art-port"]}: {e}')
+
+    if params['serve']:
+        multiplexer = Multiplexer(params, mpd_streams)
+        multiplexer.run()
+        mpd_wrappers = list(multiplexer.wrappers.values())
+    else:
+        # Create wrapper to handle connection failures with MPD more gracefully
+        mpd_wrapper = MPDWrapper(params)
+        mpd_wrapper.run()
+        mpd_wrappers = [mpd_wrapper]
+
+        flags = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
+        flags |= os.O_NONBLOCK
+        fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, flags)
+        GLib.io_add_watch(sys.stdin, GLib.IO_IN |
+                          GLib.IO_HUP, mpd_wrapper.io_callback)
 
     # Run idle loop
     try:
@@ -888,9 +1598,10 @@ if __name__ == '__main__':
         logger.debug('Caught SIGINT, exiting.')
 
     # Clean up
-    try:
-        mpd_wrapper.client.close()
-        mpd_wrapper.client.disconnect()
-        logger.debug('Exiting')
-    except mpd.ConnectionError:
-        logger.error('Failed to disconnect properly')
+    for mpd_wrapper in mpd_wrappers:
+        try:
+            mpd_wrapper.client.close()
+            mpd_wrapper.client.disconnect()
+        except mpd.ConnectionError:
+            logger.error('Failed to disconnect properly')
+    logger.debug('Exiting')
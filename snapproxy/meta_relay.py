@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Snapserver controlscript that passes its stream's JSON-RPC through to a meta_hassio.py --serve process.
+
+Only needs the standard library, so each stream costs a small process rather than a whole meta_hassio.py,
+which is where all the MPD, MusicBrainz, & GLib work happens.
+"""
+import getopt
+import json
+import os
+import selectors
+import socket
+import sys
+import time
+
+# How long to keep trying to reach the --serve process, it might've been started at the same time as snapserver
+CONNECT_TIMEOUT = 30
+CONNECT_RETRY_DELAY = 0.5
+
+
+def connect(path):
+    """Connect to the --serve process's Unix socket, retrying until CONNECT_TIMEOUT if it isn't up yet."""
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(CONNECT_RETRY_DELAY)
+
+
+def relay(path, stream):
+    """
+    Act as snapserver's controlscript for one stream by passing its JSON-RPC through to a Multiplexer.
+    """
+    sock = connect(path)
+    # The first line says which stream this is for, everything after that is JSON-RPC
+    sock.sendall((json.dumps({'stream': stream}) + '\n').encode())
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+
+    selector = selectors.DefaultSelector()
+    selector.register(stdin, selectors.EVENT_READ)
+    selector.register(sock, selectors.EVENT_READ)
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is sock:
+                data = sock.recv(64 * 1024)
+                if not data:
+                    return
+                while data:
+                    data = data[os.write(stdout, data):]
+            else:
+                data = os.read(stdin, 64 * 1024)
+                if not data:
+                    return
+                sock.sendall(data)
+
+
+def usage():
+    print(f"""\
+Usage: {sys.argv[0]} --connect=PATH [OPTION]...
+
+     --connect=PATH         Unix socket of the meta_hassio.py --serve process
+     --stream=ID            Set the stream id, snapserver passes this itself
+
+Snapserver's other controlscript options are accepted, and ignored.""", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    stream = 'default'
+    path = None
+    try:
+        # snapserver adds --stream, --snapcast-host, & --snapcast-port to whatever's in controlscriptparams
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'connect=', 'stream=', 'snapcast-host=', 'snapcast-port='])
+    except getopt.GetoptError as ex:
+        print(f"{sys.argv[0]}: {ex.msg}", file=sys.stderr)
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage()
+            sys.exit()
+        elif opt == '--connect':
+            path = arg
+        elif opt == '--stream':
+            stream = arg
+
+    if path is None or args:
+        usage()
+        sys.exit(2)
+
+    try:
+        relay(path, stream)
+    except KeyboardInterrupt:
+        pass
@@ -4,15 +4,36 @@ import datetime
 import json
 import os
 import pathlib
+import random
 import secrets
+import signal
+import socket
+import string
 import subprocess
 import sys
+import time
 
 OPTIONS_FILE = pathlib.Path('/data/options.json')
 CONFIG_FILE = pathlib.Path('/etc/snapserver.conf')
 SECRET_FILE = pathlib.Path('/data/secret')
 PULSE_COOKIE_FILE = pathlib.Path('/root/.config/pulse/cookie')
 
+# For options.json from before mpd_instances was an option
+DEFAULT_MPD_INSTANCES = [{'port': 6600, 'pulse_role': 'music'},
+                         {'port': 6601, 'pulse_role': 'event'}]
+# The MPD ports config.yaml exposes outside the add-on, keep these in sync with it
+EXPOSED_MPD_PORTS = (6600, 6601)
+# Where meta_hassio.py --serve takes JSON-RPC from each stream's meta_relay.py controlscript
+META_SOCKET = '/run/meta_hassio.sock'
+# How long to wait for a freshly started process to accept connections
+READY_TIMEOUT = 30
+# Seconds between restarts of a crashing process, doubling from the first until it reaches the second
+RESTART_DELAY = (1, 60)
+# Once a process has been up this long it's considered fixed, and the next crash restarts it quickly again
+STABLE_SECONDS = 60
+# How long to give the processes to exit after SIGTERM before they get SIGKILL
+STOP_TIMEOUT = 10
+
 if not OPTIONS_FILE.exists():
     raise Exception("No /data/options.json file")
 
@@ -44,21 +65,141 @@ sink = stderr
 filter = {HA_options['logging_filter']}
 """
 
-# FIXME: This is kinda messy with the braces because I want to resolve the mpd_port later with .format()
-#        Which means not only do I need to resolve the literal {} here, but I need to escape it twice to make it through .format()
-mpd_config_template = f"""
+# $-placeholders get filled in per instance, so the config's own braces can stay as they are
+mpd_config_template = string.Template("""
 include "/etc/mpd.conf"
 music_directory "/media/"
-playlist_directory "/media/{HA_options['media_playlists_dir']}"
-audio_output {{{{
+playlist_directory "/media/$playlists_dir"
+audio_output {
    name          "Pulseaudio snapfifo for Snapcast"
    type          "pulse"
    sink          "snapfifo"
 #   mixer_type    "software"
-   media_role    "{{pulse_role}}"
-}}}}
-port "{{mpd_port}}"
-"""
+   media_role    "$pulse_role"
+}
+port "$mpd_port"
+""")
+
+
+class Child(object):
+    """A process that gets restarted, with increasing delays, whenever it exits."""
+
+    def __init__(self, name, args, stdin_text=None, ready_port=None, env=None):
+        self.name = name
+        self.args = args
+        # Written to the process's stdin, then closed
+        self.stdin_text = stdin_text
+        # Considered ready once this TCP port accepts connections
+        self.ready_port = ready_port
+        self.env = env
+
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.restart_delay = RESTART_DELAY[0]
+
+    def start(self):
+        print(f"Starting {self.name}", file=sys.stderr, flush=True)
+        self.restart_at = None
+        self.started = time.monotonic()
+        self.process = subprocess.Popen(self.args, env=self.env, text=True,
+                                        stdin=subprocess.PIPE if self.stdin_text is not None else None)
+        if self.stdin_text is not None:
+            print(self.stdin_text, file=self.process.stdin, flush=True)
+            self.process.stdin.close()
+
+    def wait_ready(self, deadline):
+        if self.ready_port is None:
+            return True
+        while time.monotonic() < deadline:
+            if self.process is None or self.process.poll() is not None:
+                # Died already, the main loop will deal with it
+                return False
+            try:
+                socket.create_connection(('localhost', self.ready_port), timeout=1).close()
+            except OSError:
+                time.sleep(0.1)
+            else:
+                print(f"{self.name} ready on port {self.ready_port}", file=sys.stderr, flush=True)
+                return True
+        print(f"{self.name} not ready after {READY_TIMEOUT} seconds, carrying on anyway", file=sys.stderr, flush=True)
+        return False
+
+    def exited(self):
+        """Schedule a restart, backing off if it keeps crashing."""
+        if time.monotonic() - self.started >= STABLE_SECONDS:
+            self.restart_delay = RESTART_DELAY[0]
+        # Jitter so processes that died together don't all come back in lockstep
+        delay = self.restart_delay * random.uniform(0.5, 1.5)
+        self.restart_delay = min(self.restart_delay * 2, RESTART_DELAY[1])
+        print(f"{self.name} exited with status {self.process.returncode}, restarting in {delay:.1f} seconds",
+              file=sys.stderr, flush=True)
+        self.process = None
+        self.restart_at = time.monotonic() + delay
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            print(f"Stopping {self.name}", file=sys.stderr, flush=True)
+            self.process.terminate()
+
+    def wait_stopped(self, deadline):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            print(f"{self.name} still running after {STOP_TIMEOUT} seconds, killing it", file=sys.stderr, flush=True)
+            self.process.kill()
+            self.process.wait()
+
+
+def start_all(children):
+    """Start all the children at once, then wait for them to all be ready."""
+    for child in children:
+        child.start()
+    deadline = time.monotonic() + READY_TIMEOUT
+    for child in children:
+        child.wait_ready(deadline)
+
+
+def stop_all(children):
+    """Ask all the children to exit at once, then kill whichever don't in time."""
+    for child in children:
+        child.stop()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for child in children:
+        child.wait_stopped(deadline)
+
+
+def supervise(children):
+    """Restart whichever children exit, forever."""
+    while True:
+        # Reap everything, not just our own children, since we're probably PID 1
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid == 0:
+                break
+            for child in children:
+                if child.process is not None and child.process.pid == pid:
+                    # Already reaped, don't let Popen try again
+                    child.process.returncode = os.waitstatus_to_exitcode(status)
+
+        now = time.monotonic()
+        for child in children:
+            # Might've been reaped by Popen.poll() in wait_ready() instead
+            if child.process is not None and child.process.returncode is not None:
+                child.exited()
+            if child.restart_at is not None and child.restart_at <= now:
+                child.start()
+
+        time.sleep(0.5)
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
 
 if __name__ == "__main__":
     print("Dumping config to config file", flush=True)
@@ -89,44 +230,47 @@ if __name__ == "__main__":
     subprocess.check_call(['pactl', 'set-default-sink', 'snapfifo'])
     os.environ['PULSE_SINK'] = 'snapfifo'
 
-    processes = {}
-
     # FIXME: I can't make Avahi work without dbus, and dbus is simply hanging on startup with no explanation
     # # Avahi is needed for snapclients to discover this snapserver
     # # FIXME: Does discovery work for MPD?
-    # avahi = subprocess.Popen(['avahi-daemon'])
-    # processes[avahi.pid] = avahi
-
-    snapserver_args = ['snapserver', '-c', '/etc/snapserver.conf']
-    snapserver = subprocess.Popen(snapserver_args)
-    processes[snapserver.pid] = snapserver
+    # avahi = Child('avahi', ['avahi-daemon'])
 
     # FIXME: MPD seems to be the only controlable media player that doesn't struggle immensly at the beginning of a stream.
     #        Worth considering mopidy?
+    # FIXME: The event one should be louder I think
+    mpd_instances = HA_options.get('mpd_instances', DEFAULT_MPD_INSTANCES)
+    for instance in mpd_instances:
+        if instance['port'] not in EXPOSED_MPD_PORTS:
+            print(f"MPD port {instance['port']} isn't exposed outside the add-on, "
+                  "only Snapcast's stream sources will be able to reach it", file=sys.stderr, flush=True)
+    mpds = [Child(f"mpd ({instance['pulse_role']})", ['mpd', '--no-daemon', '/dev/stdin'],
+                  stdin_text=mpd_config_template.substitute(playlists_dir=HA_options['media_playlists_dir'],
+                                                            pulse_role=instance['pulse_role'],
+                                                            mpd_port=instance['port']),
+                  ready_port=instance['port'], env={'PULSE_SINK': 'snapfifo'})
+            for instance in mpd_instances]
+    # One process fetches the metadata & handles the controls for every MPD that's tied to a Snapcast stream,
+    # the streams' sources need controlscript=/meta_relay.py&controlscriptparams=--connect=/run/meta_hassio.sock
+    mpd_streams = [f"--mpd-stream={instance['stream']}=localhost:{instance['port']}"
+                   for instance in mpd_instances if instance.get('stream')]
+    metadata = [Child('meta_hassio', ['python3', '/meta_hassio.py', f'--serve={META_SOCKET}', *mpd_streams])
+                ] if mpd_streams else []
+    # 1705 is the control port, last thing snapserver opens, but it's only there if snap_config_template enabled it
+    if HA_options['tcp_enabled']:
+        snapserver_ready_port = 1705
+    elif HA_options['http_enabled']:
+        snapserver_ready_port = 1780
+    else:
+        snapserver_ready_port = None
+    snapserver = Child('snapserver', ['snapserver', '-c', '/etc/snapserver.conf'], ready_port=snapserver_ready_port)
 
-    mpd_music = subprocess.Popen(['mpd', '--no-daemon', '/dev/stdin'], env={'PULSE_SINK': 'snapfifo'},
-                                 stdin=subprocess.PIPE, text=True)
-    print(mpd_config_template.format(mpd_port=6600, pulse_role='music'),
-          sep='\n', file=mpd_music.stdin, flush=True)
-    mpd_music.stdin.close()
-    processes[mpd_music.pid] = mpd_music
-
-    # FIXME: This one should be louder I think
-    mpd_other = subprocess.Popen(['mpd', '--no-daemon', '/dev/stdin'], env={'PULSE_SINK': 'snapfifo'},
-                                 stdin=subprocess.PIPE, text=True)
-    # FIXME: Same as above except for port number, so make this a variable or something
-    print(mpd_config_template.format(mpd_port=6601, pulse_role='event'),
-          sep='\n', file=mpd_other.stdin, flush=True)
-    mpd_other.stdin.close()
-    processes[mpd_music.pid] = mpd_other
-
-    crashed = False
-    while crashed is False:
-        pid, status = os.wait()
-        print(pid, status, file=sys.stderr, flush=True)
-        if pid in processes:
-            crashed = processes.pop(pid)
-            print(f"{crashed.args[0]} crashed, killing others and exiting.", file=sys.stderr, flush=True)
-            for pid in processes:
-                print(f"Killing {processes[pid].args[0]}", file=sys.stderr, flush=True)
-                processes[pid].kill()
+    signal.signal(signal.SIGTERM, _terminate)
+    children = mpds + metadata + [snapserver]
+    try:
+        # The MPD instances first, since snapserver's stream sources might want to talk to them as soon as it starts.
+        # meta_hassio.py doesn't get waited on, the relays keep trying to connect to it for a while.
+        start_all(mpds + metadata)
+        start_all([snapserver])
+        supervise(children)
+    finally:
+        stop_all(children)
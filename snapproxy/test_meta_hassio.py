@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Tests for meta_hassio.py against a fake MPD, run with: python3 -m unittest test_meta_hassio
+"""
+import socket
+import threading
+import unittest
+
+import mpd
+
+import meta_hassio
+
+STATUS = ['volume: 50', 'repeat: 0', 'random: 1', 'single: 0', 'consume: 0',
+          'state: play', 'songid: 3', 'elapsed: 12.500', 'duration: 200.000']
+# MPD capitalises song tags, python-mpd2 lowercases them
+CURRENTSONG = ['file: music/song.flac', 'Artist: First Artist', 'Artist: Second Artist', 'Title: A Song',
+               'Album: An Album', 'Track: 4', 'duration: 200.000', 'Pos: 0', 'Id: 3']
+COMMANDS = ['status', 'currentsong', 'commands', 'urlhandlers', 'idle', 'noidle']
+
+
+class FakeMPD(object):
+    """Just enough of MPD's protocol to test MPDWrapper against, one client at a time."""
+
+    def __init__(self):
+        self._listener = socket.create_server(('localhost', 0))
+        self.port = self._listener.getsockname()[1]
+        # Every line the client has sent
+        self.received = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        sock, _addr = self._listener.accept()
+        rfile = sock.makefile('r', encoding='utf-8', newline='\n')
+        wfile = sock.makefile('w', encoding='utf-8', newline='\n')
+        wfile.write('OK MPD 0.23.5\n')
+        wfile.flush()
+        command_list = None
+        for line in rfile:
+            line = line.rstrip('\n')
+            self.received.append(line)
+            if line == 'command_list_ok_begin':
+                command_list = []
+            elif line == 'command_list_end':
+                response = []
+                for command in command_list:
+                    if command not in COMMANDS:
+                        response.append(f'ACK [5@{command_list.index(command)}] {{{command}}} unknown command')
+                        break
+                    response.extend(self.respond(command))
+                    response.append('list_OK')
+                else:
+                    response.append('OK')
+                wfile.write(''.join(response_line + '\n' for response_line in response))
+                command_list = None
+            elif command_list is not None:
+                command_list.append(line)
+            elif line == 'idle':
+                # Nothing ever changes, so this only gets answered by noidle
+                continue
+            else:
+                wfile.write(''.join(response_line + '\n' for response_line in self.respond(line) + ['OK']))
+            wfile.flush()
+        sock.close()
+
+    def respond(self, command):
+        if command == 'status':
+            return STATUS
+        elif command == 'currentsong':
+            return CURRENTSONG
+        elif command == 'commands':
+            return [f'command: {name}' for name in COMMANDS]
+        elif command == 'urlhandlers':
+            return ['handler: http://']
+        return []
+
+    def close(self):
+        self._listener.close()
+
+
+class FakeArtFetcher(object):
+    """Never finds any album art, rather than asking MusicBrainz."""
+
+    def request(self, key, snapmeta, callback):
+        pass
+
+
+class MPDWrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.mpd = FakeMPD()
+        self.addCleanup(self.mpd.close)
+        self.sent = []
+        params = {**meta_hassio.params, **meta_hassio.defaults, 'mpd-port': self.mpd.port, 'art-cache': ':memory:'}
+        self.wrapper = meta_hassio.MPDWrapper(params, send=self.sent.append, art_fetcher=FakeArtFetcher())
+        self.addCleanup(self.wrapper.disconnect)
+
+    def test_connect(self):
+        # False means connected, and not to try again
+        self.assertFalse(self.wrapper.my_connect())
+        self.assertIn({"jsonrpc": "2.0", "method": "Plugin.Stream.Ready"}, self.sent)
+        # The status & song came from a single command list, and it went back to idling straight after
+        self.assertEqual(self.mpd.received[-5:],
+                         ['command_list_ok_begin', 'status', 'currentsong', 'command_list_end', 'idle'])
+        self.assertEqual(self.wrapper.get_metadata(), {
+            'url': 'music/song.flac', 'trackId': '3', 'artist': ['First Artist', 'Second Artist'],
+            'title': 'A Song', 'album': 'An Album', 'trackNumber': 4, 'duration': 200.0})
+
+    def test_command_batch(self):
+        self.assertFalse(self.wrapper.my_connect())
+        status, song = self.wrapper.command_batch([('status',), ('currentsong',)])
+        self.assertEqual(status['state'], 'play')
+        self.assertEqual(song['artist'], ['First Artist', 'Second Artist'])
+        self.assertEqual(self.mpd.received[-6:],
+                         ['noidle', 'command_list_ok_begin', 'status', 'currentsong', 'command_list_end', 'idle'])
+
+    def test_command_batch_error(self):
+        self.assertFalse(self.wrapper.my_connect())
+        with self.assertRaises(mpd.CommandError):
+            self.wrapper.command_batch([('status',), ('bogus',)])
+        # MPD still gets to the idle after the failed list
+        self.assertTrue(self.wrapper._idling)
+        status, = self.wrapper.command_batch([('status',)])
+        self.assertEqual(status['songid'], '3')
+
+
+if __name__ == '__main__':
+    unittest.main()